@@ -0,0 +1,537 @@
+"""
+bench.py: Benchmarks for the dictionary build.
+
+    python bench.py taggers [--toolbox FILE] [--taggers corenlp rules]
+    python bench.py split [--toolbox FILE]
+    python bench.py memory [--entries N | --toolbox FILE]
+    python bench.py workers [--entries N | --toolbox FILE] [--max-workers N]
+    python bench.py sorting [--entries N | --toolbox FILE]
+    python bench.py glosses [--entries N | --toolbox FILE]
+    python bench.py normalize [--entries N | --toolbox FILE]
+    python bench.py snapshot [--entries N | --toolbox FILE]
+    python bench.py incremental [--entries N | --toolbox FILE]
+    python bench.py latex [--entries N | --toolbox FILE] [--shards 1 2 4]
+    python bench.py render [--entries N N ...]
+    python bench.py suite [--entries N] [generator options] [--output FILE] [--compare FILE]
+    python bench.py compare BASELINE CANDIDATE [--threshold 0.1]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import shutil
+import tempfile
+import time
+import tracemalloc
+from operator import itemgetter, attrgetter
+import natsort
+from natsort.ns_enum import ns
+import env
+from parse import load_toolbox
+import entries
+from entries import build_basic_tbentries, expand_conventions_batch, escape_latex_batch, pick_sense, scan_definition
+from entries import Dictionary, DictEntry, GlossNode, TBEntry, natural_key, canonicalize_defn, sort_main_entries, sort_subheading_keys, sort_subheading_entries, sort_top_dictentries
+from taggers import RulesTagger, StubTagger
+from taggers import TAGGERS
+from synthetic import synthetic_toolbox
+import synthetic
+from metrics import BuildMetrics
+from build import compile_latex, compile_shards, write_latex
+from cache import content_hash
+from snapshot import load_snapshot, save_snapshot
+
+# The stub is only for benchmarks, builds can't pick it.
+BENCH_TAGGERS = {**TAGGERS, StubTagger.name: StubTagger}
+
+def load_senses(toolbox_file: str) -> list[str]:
+    with open(toolbox_file) as f:
+        crkentries = build_basic_tbentries(load_toolbox(f.read()))
+    headings = {gloss[0] for entry in crkentries for gloss in entry.glosses if gloss[0]}
+    senses = {sense for entry in crkentries for sense in entry.subsenses_expanded if sense.strip()}
+    return sorted(headings | senses)
+
+def bench_taggers(args):
+    sentences = load_senses(args.toolbox)
+    print(f"{len(sentences)} unique headings and senses from {args.toolbox}")
+    reference = None
+    for name in args.taggers:
+        tagger = BENCH_TAGGERS[name]()
+        start = time.perf_counter()
+        tagged = tagger.tag(sentences)
+        elapsed = time.perf_counter() - start
+        # What matters for the dictionary is what pick_sense makes of the tags, not the tags themselves.
+        picked = [pick_sense(parsed, sentence, None) for parsed, sentence in zip(tagged, sentences)]
+        if reference is None:
+            reference = (name, picked)
+            agreement = ""
+        else:
+            same = sum(1 for a, b in zip(reference[1], picked) if a == b)
+            agreement = f"  {same}/{len(picked)} ({100 * same / len(picked):.1f}%) same as {reference[0]}"
+        print(f"{name:>10}: {elapsed:8.3f}s  {len(sentences) / elapsed:10.0f} sentences/s{agreement}")
+
+def measure(function, *args):
+    # Time and memory are measured on separate runs, tracemalloc slows everything down.
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    del result
+    tracemalloc.start()
+    result = function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+# How definitions were split before scan_definition, a character at a time; the reference for it.
+def annotate_nesting_levels( data: str, nest_increase=["(","["], nest_decrease=[")","]"]) -> list[tuple[int,str]]:
+    # Note that this method does not check that parenthesis are properly balanced,
+    # as this is only going to be used to keep the main level anyways.
+    level = 0
+    def calc_level(char):
+        nonlocal level
+        if char in nest_increase:
+            level += 1
+        elif char in nest_decrease:
+            level -= 1
+        return level
+    return [ (calc_level(char), char) for char in data ]
+
+def nested_split ( nested_data: list[tuple[int,str]], char: str, level=0 ) -> list[list[tuple[int,str]]]:
+    split = []
+    current = []
+    for data in nested_data:
+        if data == (level, char):
+            split.append(current)
+            current=[]
+        else:
+            current.append(data)
+    split.append(current)
+    return split
+
+def drop_nested( original_annotated_nesting: list[tuple[int,str]]) -> str:
+    return ''.join([
+        x[1]
+        for x in original_annotated_nesting
+        if x[0] == 0
+    ])
+
+def split_annotated(definitions: list[str]):
+    # What TBEntry.populate_fields used to do, keeping the per-character (level, char) lists like it did.
+    results = []
+    for defn in definitions:
+        annotated = annotate_nesting_levels(defn)
+        senses = nested_split(annotated, ";")
+        subsenses = [x for sense in senses for x in nested_split(sense, ",")]
+        results.append((
+            [''.join([x[1] for x in sense]) for sense in senses],
+            [''.join([x[1] for x in subsense]) for subsense in subsenses],
+            drop_nested(annotated),
+            (annotated, senses, subsenses),
+        ))
+    return results
+
+def split_scanned(definitions: list[str]):
+    return [scan_definition(defn) for defn in definitions]
+
+def bench_split(args):
+    with open(args.toolbox) as f:
+        definitions = [value for entry in load_toolbox(f.read()) for key, value in entry if key == "\\def"]
+    print(f"{len(definitions)} definitions from {args.toolbox}")
+    annotated, elapsed, peak = measure(split_annotated, definitions)
+    print(f"{'annotated':>10}: {elapsed:8.3f}s  peak {peak / 1024 / 1024:8.1f} MiB")
+    scanned, elapsed, peak = measure(split_scanned, definitions)
+    print(f"{'scanned':>10}: {elapsed:8.3f}s  peak {peak / 1024 / 1024:8.1f} MiB")
+    print("same output" if [x[:3] for x in annotated] == scanned else "OUTPUT DIFFERS")
+
+def load_data(args):
+    if args.toolbox:
+        with open(args.toolbox) as f:
+            return load_toolbox(f.read())
+    return load_toolbox(synthetic_toolbox(args.entries))
+
+def bench_memory(args):
+    data = load_data(args)
+    mib = 1024 * 1024
+    tracemalloc.start()
+    crkentries = build_basic_tbentries(data)
+    built, peak = tracemalloc.get_traced_memory()
+    print(f"build_basic_tbentries over {len(crkentries)} entries: {built / mib:8.1f} MiB held, {peak / mib:8.1f} MiB peak")
+    # Everything the old eager TBEntry computed and kept for every entry (bar the per-character lists).
+    eager = [
+        (entry.senses, entry.subsenses, entry.subsenses_expanded, entry.canonicalized_definitions, entry.canonicalized_senses, entry.canonicalized_subsenses)
+        for entry in crkentries
+    ]
+    derived, _ = tracemalloc.get_traced_memory()
+    print(f"{'with every derived field kept':>44}: {derived / mib:8.1f} MiB held")
+    del eager
+    for entry in crkentries:
+        entry.drop_derived()
+    dropped, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{'after drop_derived':>44}: {dropped / mib:8.1f} MiB held")
+
+def bench_workers(args):
+    data = load_data(args)
+    baseline = None
+    workers = 1
+    while True:
+        start = time.perf_counter()
+        crkentries = build_basic_tbentries(data, workers)
+        # Split definitions in the serial case too, the parallel build does it in the workers.
+        for entry in crkentries:
+            entry.scans
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(f"{workers:>3} workers: {elapsed:8.3f}s  {baseline / elapsed:5.2f}x")
+        if workers >= args.max_workers:
+            break
+        workers = min(workers * 2, args.max_workers)
+
+# The two-pass natsorts the sort functions in entries.py used to do; the reference for their order.
+def natsorted_twice(entries, first, second):
+    candidates = natsort.natsorted(entries, key=second, alg=ns.NUMAFTER | ns.GROUPLETTERS | ns.LOWERCASEFIRST)
+    return natsort.natsorted(candidates, key=first, alg=ns.NUMAFTER | ns.GROUPLETTERS | ns.LOWERCASEFIRST)
+
+def reference_sort_entries(entries):
+    candidates = natsorted_twice(entries, lambda x: x[0][0], lambda x: x[0][2])
+    return [(canonicalize_defn(split_defn), entry) for split_defn, entry in candidates]
+
+def reference_sort_subheading_keys(entries, heading):
+    return [''.join(t) for t in natsorted_twice([entry.partition(heading) for entry in entries], itemgetter(0), itemgetter(2))]
+
+def bench_sorting(args):
+    dictionary = Dictionary(load_data(args), RulesTagger(), workers=1)
+    # Check every sort against the reference on every heading of the dictionary.
+    mismatches = 0
+    for heading, body in dictionary.entries.items():
+        if not heading:
+            continue
+        parsed_heading = pick_sense(dictionary.parsed_keys[heading], heading, None)
+        main = body.matches(parsed_heading)
+        mismatches += sort_main_entries(main) != reference_sort_entries(main)
+        keys = list(body.children)
+        mismatches += sort_subheading_keys(keys, heading) != reference_sort_subheading_keys(keys, heading)
+        for key in keys:
+            sub = body.children[key].matches(key)
+            mismatches += sort_subheading_entries(sub) != reference_sort_entries(sub)
+    context = dictionary.context()
+    reference = natsort.natsorted(context, key=attrgetter("head"), alg=ns.NUMAFTER | ns.GROUPLETTERS | ns.LOWERCASEFIRST)
+    mismatches += [x.head for x in sort_top_dictentries(context)] != [x.head for x in reference]
+    print(f"{len(context)} headings, {mismatches} orderings differ from the two-pass natsort")
+
+    for cache in ["cold", "warm"]:
+        if cache == "cold":
+            natural_key.cache_clear()
+        dictionary.dictentries.clear()
+        start = time.perf_counter()
+        dictionary.context()
+        print(f"Dictionary.context() ({cache} sort keys): {time.perf_counter() - start:8.3f}s")
+    if mismatches:
+        raise SystemExit(1)
+
+def simplify_defns(remove:str, entry: TBEntry) -> list[tuple[str,str,str]]:
+    # What entry.matches holds for `remove`, worked out from scratch.
+    defns = [defn for defn in entry.processed_subsenses if remove in defn]
+    return [defn.partition(remove) for defn in defns]
+
+class ScannedDictEntry(DictEntry):
+    # DictEntry as it was before the match index: every heading scans the senses of all its entries.
+    def __init__(self, heading: str, parsed_heading: str, node: GlossNode):
+        self.head = heading
+        self.main_entries = sort_main_entries([(split_defn, entry) for entry in node.entries for split_defn in simplify_defns(parsed_heading, entry)])
+        self.subheading_keys = sort_subheading_keys(list(node.children), heading)
+        self.subheadings = []
+        for key in self.subheading_keys:
+            self.subheadings.append((key, sort_subheading_entries([(split_defn, entry) for entry in node.children[key].entries for split_defn in simplify_defns(key, entry)])))
+
+def bench_glosses(args):
+    dictionary = Dictionary(load_data(args), RulesTagger(), workers=1)
+    headings = dictionary.sorted_headings()
+    start = time.perf_counter()
+    for entry in dictionary.crkentries:
+        dictionary.match_entry(entry)
+    print(f"{'index':>8}: {time.perf_counter() - start:8.3f}s for {len(dictionary.crkentries)} entries (done while tagging)")
+    results = dict()
+    for name, make in [("scanned", ScannedDictEntry), ("indexed", DictEntry)]:
+        start = time.perf_counter()
+        results[name] = [make(heading, dictionary.picked_keys[heading], dictionary.entries[heading]) for heading in headings]
+        print(f"{name:>8}: {time.perf_counter() - start:8.3f}s for {len(headings)} headings")
+    same = all(
+        a.main_entries == b.main_entries and a.subheadings == b.subheadings
+        for a, b in zip(results["scanned"], results["indexed"])
+    )
+    print("same entries" if same else "ENTRIES DIFFER")
+    if not same:
+        raise SystemExit(1)
+
+# What expand_conventions and canonicalize_defn did to every string, one after the other; the reference for the batch passes.
+def reference_expand(defn: str) -> str:
+    return defn.replace("s.o.","someone").replace("s.t.","something").replace("S/he","she").replace("s/he","she")
+
+def reference_escape(text: str) -> str:
+    return text.replace("&","\\&").replace("{","\\{").replace("}","\\}").replace("#","\\#").replace("$","\\$").strip()
+
+def bench_normalize(args):
+    dictionary = Dictionary(load_data(args), RulesTagger(), workers=1)
+    senses = [subsense for entry in dictionary.crkentries for subsense in entry.subsenses]
+    parts = [part for entry in dictionary.crkentries for splits in entry.matches.values() for split in splits for part in split]
+    print(f"{len(senses)} senses ({len(set(senses))} unique), {len(parts)} split parts ({len(set(parts))} unique)")
+    mismatches = 0
+    for name, reference, batch in [
+        ("expand", lambda: [reference_expand(sense) for sense in senses], lambda: expand_conventions_batch(senses)),
+        ("escape", lambda: [reference_escape(part) for part in parts], lambda: (entries._escaped.clear(), escape_latex_batch(parts))),
+    ]:
+        start = time.perf_counter()
+        expected = reference()
+        chained = time.perf_counter() - start
+        start = time.perf_counter()
+        done = batch()
+        batched = time.perf_counter() - start
+        got = [done[sense] for sense in senses] if name == "expand" else [entries._escaped[part] for part in parts]
+        mismatches += sum(a != b for a, b in zip(expected, got))
+        print(f"{name:>8}: {chained:8.3f}s chained replaces, {batched:8.3f}s batched")
+    print(f"{mismatches} strings differ")
+    if mismatches:
+        raise SystemExit(1)
+
+def bench_snapshot(args):
+    data = load_data(args)
+    tagger = RulesTagger()
+    start = time.perf_counter()
+    dictionary = Dictionary(data, tagger, workers=1)
+    built = time.perf_counter() - start
+    expected = dictionary.latex()
+    source = content_hash(str(args.entries), args.toolbox or "")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.snapshot")
+        start = time.perf_counter()
+        save_snapshot(path, dictionary, source, keep=1)
+        saved = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded = load_snapshot(path, source, tagger, data)
+        elapsed = time.perf_counter() - start
+        print(f"{'build':>8}: {built:8.3f}s (parsing, grouping and tagging)")
+        print(f"{'save':>8}: {saved:8.3f}s, {os.path.getsize(path) / 1024 / 1024:.1f} MiB")
+        print(f"{'load':>8}: {elapsed:8.3f}s")
+        same = loaded is not None and loaded.latex() == expected
+        stale = load_snapshot(path, content_hash("another file"), tagger, data) is None
+    print("same LaTeX" if same else "LATEX DIFFERS")
+    print("another source falls back" if stale else "ANOTHER SOURCE LOADED")
+    if not same or not stale:
+        raise SystemExit(1)
+
+def bench_incremental(args):
+    data = load_data(args)
+    start = time.perf_counter()
+    full = Dictionary(data, RulesTagger(), workers=1)
+    full.context()
+    full_time = time.perf_counter() - start
+    print(f"full build:        {full_time:8.3f}s")
+    # Edit the definition of one entry in the middle of the file.
+    edited = [list(x) for x in data]
+    middle = edited[len(edited) // 2]
+    position = next(i for i, (key, _) in enumerate(middle) if key == "\\def")
+    middle[position] = ("\\def", middle[position][1] + ", s/he also edits s.t.")
+    start = time.perf_counter()
+    rebuilt = Dictionary(edited, RulesTagger(), workers=1, previous=full)
+    rebuilt.context()
+    rebuild_time = time.perf_counter() - start
+    print(f"one-entry rebuild: {rebuild_time:8.3f}s  ({100 * rebuild_time / full_time:.1f}% of a full build)")
+    fresh = Dictionary(edited, RulesTagger(), workers=1)
+    print("same LaTeX as a full build" if fresh.latex() == rebuilt.latex() else "LATEX DIFFERS FROM A FULL BUILD")
+
+def bench_latex(args):
+    if shutil.which("pdflatex") is None:
+        raise SystemExit("pdflatex is not on the PATH.")
+    dictionary = Dictionary(load_data(args), RulesTagger(), workers=1)
+    dictionary.context()
+    baseline = None
+    for shards in args.shards:
+        with tempfile.TemporaryDirectory(prefix="arok-bench-") as scratch:
+            start = time.perf_counter()
+            tex_files = write_latex(dictionary, scratch, shards)
+            rendered = time.perf_counter() - start
+            pdf = compile_shards(tex_files, scratch) if len(tex_files) > 1 else compile_latex(tex_files[0])
+            elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(f"{len(tex_files):>3} shards: render {rendered:8.3f}s  total {elapsed:8.3f}s  {baseline / elapsed:5.2f}x  {len(pdf) / 1024:8.0f} KiB")
+
+def bench_render(args):
+    mib = 1024 * 1024
+    for count in args.entries:
+        dictionary = Dictionary(load_toolbox(synthetic_toolbox(count)), RulesTagger(), workers=1)
+        with tempfile.TemporaryDirectory(prefix="arok-bench-") as scratch:
+            tex_file = os.path.join(scratch, "dict.tex")
+            def to_string():
+                with open(tex_file, "w") as f:
+                    f.write(dictionary.latex())
+                dictionary.dictentries.clear()
+            def streamed():
+                with open(tex_file, "w") as f:
+                    dictionary.write_latex(f, keep=False)
+            results = []
+            for function in (to_string, streamed):
+                _, elapsed, peak = measure(function)
+                results.append(f"{elapsed:7.3f}s {peak / mib:8.1f} MiB peak")
+            size = os.path.getsize(tex_file) / mib
+        print(f"{count:>8} entries ({size:6.1f} MiB of LaTeX):  string {results[0]}  streamed {results[1]}")
+
+def run_suite(text: str, repeat: int) -> dict[str, list[float]]:
+    # The pipeline step by step, on one worker and with the stub tagger, so runs only differ by the code.
+    timings: dict[str, list[float]] = dict()
+    def timed(name, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.setdefault(name, []).append(time.perf_counter() - start)
+        return result
+    for _ in range(repeat):
+        data = timed("load_toolbox", load_toolbox, text)
+        timed("build_basic_tbentries", lambda: [entry.scans for entry in build_basic_tbentries(data)])
+        metrics = BuildMetrics()
+        dictionary = timed("Dictionary", Dictionary, data, StubTagger(), 1, None, metrics.enter)
+        metrics.close()
+        stages = metrics.snapshot()
+        timings.setdefault("grouping", []).append(stages["grouping"]["wall"])
+        timings.setdefault("tagging (stub)", []).append(stages["tagging"]["wall"])
+        natural_key.cache_clear()
+        timed("context", dictionary.context)
+        with open(os.devnull, "w") as f:
+            timed("render", dictionary.write_latex, f)
+    return timings
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(baseline: dict, candidate: dict, threshold: float) -> list[str]:
+    # Compares the fastest run of each benchmark, the least noisy number we have.
+    regressions = []
+    if baseline["parameters"] != candidate["parameters"]:
+        print("Warning: the runs were made with different parameters, the comparison may not mean much.")
+    print(f"{'benchmark':>22}  {'baseline':>9}  {'candidate':>9}  change")
+    for name, result in candidate["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before, after = baseline["results"][name]["min"], result["min"]
+        change = after / before - 1 if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:>22}  {before:8.3f}s  {after:8.3f}s  {100 * change:+6.1f}%{flag}")
+    return regressions
+
+def bench_suite(args):
+    parameters = {"entries": args.entries, "repeat": args.repeat, **synthetic.options(args)}
+    text = synthetic_toolbox(args.entries, **synthetic.options(args))
+    timings = run_suite(text, args.repeat)
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "parameters": parameters,
+        "results": {name: {"min": min(runs), "median": statistics.median(runs), "runs": runs} for name, runs in timings.items()},
+    }
+    for name, result in results["results"].items():
+        print(f"{name:>22}: min {result['min']:8.3f}s  median {result['median']:8.3f}s")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare_results(baseline, results, args.threshold):
+            raise SystemExit(1)
+
+def bench_compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if compare_results(baseline, candidate, args.threshold):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the dictionary build.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    taggers = commands.add_parser("taggers", help="Compare speed and output of the tagger backends.")
+    taggers.add_argument("--toolbox", default=env.TOOLBOX_FILE)
+    taggers.add_argument("--taggers", nargs="+", choices=list(BENCH_TAGGERS), default=list(BENCH_TAGGERS),
+                         help="The first one is the reference the others are compared against.")
+    taggers.set_defaults(run=bench_taggers)
+
+    split = commands.add_parser("split", help="Compare definition splitting against the per-character annotation it replaced.")
+    split.add_argument("--toolbox", default=env.TOOLBOX_FILE)
+    split.set_defaults(run=bench_split)
+
+    memory = commands.add_parser("memory", help="Memory held by TBEntry objects, built from a synthetic file unless --toolbox is given.")
+    memory.add_argument("--entries", type=int, default=100000)
+    memory.add_argument("--toolbox")
+    memory.set_defaults(run=bench_memory)
+
+    workers = commands.add_parser("workers", help="Scaling of the multi-process entry build, from 1 to --max-workers.")
+    workers.add_argument("--entries", type=int, default=100000)
+    workers.add_argument("--toolbox")
+    workers.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    workers.set_defaults(run=bench_workers)
+
+    sorting = commands.add_parser("sorting", help="Check the natural sort order against the two-pass natsort, and time Dictionary.context().")
+    sorting.add_argument("--entries", type=int, default=30000)
+    sorting.add_argument("--toolbox")
+    sorting.set_defaults(run=bench_sorting)
+
+    glosses = commands.add_parser("glosses", help="Build every heading from the sense match index and by scanning senses, and check they agree.")
+    glosses.add_argument("--entries", type=int, default=30000)
+    glosses.add_argument("--toolbox")
+    glosses.set_defaults(run=bench_glosses)
+
+    normalize = commands.add_parser("normalize", help="Time convention expansion and LaTeX escaping of every sense, batched against one string at a time, and check they agree.")
+    normalize.add_argument("--entries", type=int, default=30000)
+    normalize.add_argument("--toolbox")
+    normalize.set_defaults(run=bench_normalize)
+
+    snapshot = commands.add_parser("snapshot", help="Time saving and loading a snapshot of the built dictionary against building it, and check it renders the same.")
+    snapshot.add_argument("--entries", type=int, default=30000)
+    snapshot.add_argument("--toolbox")
+    snapshot.set_defaults(run=bench_snapshot)
+
+    incremental = commands.add_parser("incremental", help="Time a rebuild after a one-entry edit against a full build.")
+    incremental.add_argument("--entries", type=int, default=30000)
+    incremental.add_argument("--toolbox")
+    incremental.set_defaults(run=bench_incremental)
+
+    latex = commands.add_parser("latex", help="Wall time of pdflatex on the whole document against letter shards compiled in parallel.")
+    latex.add_argument("--entries", type=int, default=30000)
+    latex.add_argument("--toolbox")
+    latex.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1],
+                       help="The first one is the baseline the others are compared against.")
+    latex.set_defaults(run=bench_latex)
+
+    render = commands.add_parser("render", help="Peak memory of rendering the LaTeX to a string against streaming it to a file, as the dictionary grows.")
+    render.add_argument("--entries", type=int, nargs="+", default=[10000, 20000, 40000, 80000])
+    render.set_defaults(run=bench_render)
+
+    suite = commands.add_parser("suite", help="Time each step of the pipeline on a synthetic file, offline, and store the results as JSON.")
+    suite.add_argument("--entries", type=int, default=30000)
+    suite.add_argument("--repeat", type=int, default=5)
+    synthetic.add_arguments(suite)
+    suite.add_argument("--output", help="Write the results to this JSON file.")
+    suite.add_argument("--compare", metavar="BASELINE", help="Compare against the results in this JSON file, exit 1 on a regression.")
+    suite.add_argument("--threshold", type=float, default=0.1, help="How much slower (0.1 is 10%%) counts as a regression.")
+    suite.set_defaults(run=bench_suite)
+
+    compare = commands.add_parser("compare", help="Compare two suite results, exit 1 on a regression.")
+    compare.add_argument("baseline")
+    compare.add_argument("candidate")
+    compare.add_argument("--threshold", type=float, default=0.1, help="How much slower (0.1 is 10%%) counts as a regression.")
+    compare.set_defaults(run=bench_compare)
+
+    args = parser.parse_args()
+    args.run(args)
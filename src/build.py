@@ -0,0 +1,302 @@
+"""
+build.py: Runs the expensive part of a request (grouping, tagging, LaTeX and pdflatex) in a bounded pool.
+"""
+import cProfile
+import os
+import re
+import shutil
+import tempfile
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+from latex import LatexBuildError
+from latex.build import PdfLatexBuilder
+from cache import ArtifactCache, content_hash, file_hash
+from entries import make_dictionary, stitch_latex, Dictionary
+from jobs import Job, JobStore, page_path
+from metrics import BuildMetrics, log_build, process_peak_rss_kib, registry
+from snapshot import load_snapshot, save_snapshot, snapshot_file
+from taggers import Tagger
+import env
+
+class BuildPool:
+    """
+    At most `workers` builds run at once and at most `queue_depth` more wait for a turn.
+    A build reserves its slot before its upload is even read: past that many, reserve() turns
+    it away at once instead of letting it hang. The slot goes back when the submitted build
+    is done, or on cancel() if nothing gets submitted after all.
+    """
+
+    def __init__(self, workers: int, queue_depth: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="build")
+        self.slots = threading.BoundedSemaphore(workers + queue_depth)
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> bool:
+        if not self.slots.acquire(blocking=False):
+            registry.increment("busy")
+            return False
+        with self.lock:
+            self.pending += 1
+        return True
+
+    def submit(self, function, *args) -> Future:
+        # Runs in the slot reserve() took.
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(self.release)
+        return future
+
+    def cancel(self):
+        self.release(None)
+
+    def release(self, future: Future | None):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# The last few dictionaries built, by upload file name, to rebuild incrementally from. Oldest first.
+previous_builds: dict[str | None, Dictionary] = dict()
+_previous_lock = threading.Lock()
+
+def take_previous(name: str | None) -> Dictionary | None:
+    # Taken out while rebuilding, so two uploads of the same file don't both build on it.
+    with _previous_lock:
+        return previous_builds.pop(name, None)
+
+def keep_previous(name: str | None, dictionary: Dictionary):
+    with _previous_lock:
+        previous_builds[name] = dictionary
+        while len(previous_builds) > env.INCREMENTAL_BUILDS:
+            del previous_builds[next(iter(previous_builds))]
+
+def build_version() -> str:
+    # Anything that can change the LaTeX or the PDF of an upload: the templates and the code that fills them.
+    root = os.path.dirname(os.path.abspath(__file__))
+    files = [os.path.join(root, name) for name in ("parse.py", "entries.py", "taggers.py", "stanford.py", "build.py")]
+    templates = os.path.join(root, "templates")
+    files += sorted(os.path.join(templates, name) for name in os.listdir(templates))
+    parts = []
+    for name in files:
+        with open(name, "rb") as f:
+            parts.append(f.read())
+    return content_hash(*parts)
+
+BUILD_VERSION = build_version()
+
+_artifacts: ArtifactCache | None = None
+_artifacts_lock = threading.Lock()
+
+def get_artifacts() -> ArtifactCache:
+    global _artifacts
+    with _artifacts_lock:
+        if _artifacts is None:
+            _artifacts = ArtifactCache(env.ARTIFACT_DIR, env.ARTIFACT_MAX_BYTES)
+        return _artifacts
+
+def upload_key(upload_hash: str, tagger: Tagger, shards: int) -> str:
+    return content_hash(BUILD_VERSION, tagger.name, str(shards), upload_hash)
+
+def snapshot_key(upload_hash: str, tagger: Tagger) -> str:
+    # What the dictionary is built from; the LaTeX shards don't come into it.
+    return content_hash(BUILD_VERSION, tagger.name, upload_hash)
+
+def compile_latex(tex_file: str) -> bytes:
+    builder = PdfLatexBuilder(pdflatex="pdflatex")
+    with open(tex_file, "rb") as f:
+        return bytes(builder.build_pdf(f))
+
+def compile_shards(tex_files: list[str], scratch: str) -> bytes:
+    # Every shard gets its own pdflatex. The stitching pass only lays the finished pages end to end and numbers them.
+    with ThreadPoolExecutor(max_workers=len(tex_files), thread_name_prefix="pdflatex") as pool:
+        pdfs = list(pool.map(compile_latex, tex_files))
+    pdf_files = []
+    for tex_file, pdf in zip(tex_files, pdfs):
+        # pdflatex runs in a directory of its own, so the stitching pass can't find the shards from a relative SCRATCH_DIR.
+        pdf_files.append(os.path.abspath(os.path.splitext(tex_file)[0] + ".pdf"))
+        with open(pdf_files[-1], "wb") as f:
+            f.write(pdf)
+    stitch_file = os.path.join(scratch, "dict.tex")
+    with open(stitch_file, "w", encoding="utf-8") as f:
+        f.write(stitch_latex(pdf_files))
+    return compile_latex(stitch_file)
+
+def write_latex(dictionary: Dictionary, scratch: str, shards: int = 1, keep: bool = False) -> list[str]:
+    # The whole document, or one per shard, rendered straight into files in the scratch directory. Unless `keep`,
+    # each heading is let go once written, so memory stays flat however big the dictionary is.
+    parts = dictionary.shard_headings(shards)
+    tex_files = []
+    for i, headings in enumerate(parts):
+        tex_files.append(os.path.join(scratch, f"shard-{i:02}.tex" if len(parts) > 1 else "dict.tex"))
+        with open(tex_files[-1], "w", encoding="utf-8") as f:
+            dictionary.write_latex(f, headings, sharded=len(parts) > 1, keep=keep)
+    return tex_files
+
+# Page objects, but not the page tree (/Pages) nor anything else starting with /Page.
+_PAGE = re.compile(rb"/Type\s*/Page(?![A-Za-z])")
+_OBJECT_STREAM = re.compile(rb"<<[^<>]*/Type\s*/ObjStm[^<>]*>>\s*stream\r?\n")
+
+def count_pages(pdf: bytes) -> int:
+    # pdflatex packs most objects, pages included, into compressed object streams.
+    pages = len(_PAGE.findall(pdf))
+    # Sliced without copying what follows each stream, which would be quadratic in the size of the PDF.
+    data = memoryview(pdf)
+    for match in _OBJECT_STREAM.finditer(pdf):
+        try:
+            pages += len(_PAGE.findall(zlib.decompressobj().decompress(data[match.end():])))
+        except zlib.error:
+            pass
+    return pages
+
+def get_dictionary(toolbox: list[list[tuple[str, str]]], tagger: Tagger, workers: int, name: str | None, on_stage: Callable[[str], None], metrics: BuildMetrics, upload_hash: str | None) -> tuple[Dictionary, bool]:
+    # The snapshot of this very upload when there is one, or else a build, incremental if it can be. True if it was loaded.
+    snapshot = snapshot_file(env.SNAPSHOT_DIR, name)
+    source = snapshot_key(upload_hash, tagger) if upload_hash is not None else None
+    dictionary = None
+    if source is not None and os.path.exists(snapshot):
+        on_stage("loading snapshot")
+        dictionary = load_snapshot(snapshot, source, tagger, toolbox)
+    if dictionary is not None:
+        metrics.count("loading snapshot", entries=len(dictionary.crkentries), headings=sum(1 for heading in dictionary.entries if heading))
+        return dictionary, True
+    dictionary = make_dictionary(toolbox, tagger, workers, take_previous(name), on_stage)
+    print("Dictionary made. building...")
+    metrics.count("parsing", entries=dictionary.stats["entries"], new_entries=dictionary.stats["new_entries"])
+    metrics.count("grouping", headings=sum(1 for heading in dictionary.entries if heading))
+    metrics.count("tagging", headings=dictionary.stats["headings_tagged"], senses=dictionary.stats["senses_tagged"], **tagger.stats)
+    return dictionary, False
+
+def kept(upload_hash: str | None, loaded: bool) -> bool:
+    # Whether keep_dictionary will hold on to the dictionary, as a previous build or in a snapshot. Only then
+    # are its rendered headings worth keeping: the next build of the file carries over those that haven't changed.
+    return env.INCREMENTAL_BUILDS > 0 or (upload_hash is not None and not loaded and env.SNAPSHOT_KEEP > 0)
+
+def keep_dictionary(dictionary: Dictionary, tagger: Tagger, name: str | None, on_stage: Callable[[str], None], metrics: BuildMetrics, upload_hash: str | None, loaded: bool):
+    # Called once rendered, so the snapshot carries the sorted headings too.
+    keep_previous(name, dictionary)
+    if upload_hash is None or loaded:
+        return
+    on_stage("saving snapshot")
+    snapshot = snapshot_file(env.SNAPSHOT_DIR, name)
+    try:
+        save_snapshot(snapshot, dictionary, snapshot_key(upload_hash, tagger), env.SNAPSHOT_KEEP)
+        metrics.count("saving snapshot", snapshot_bytes=os.path.getsize(snapshot))
+    except OSError as e:
+        print(f"Couldn't save the snapshot of {name}: {e!r}")
+
+def build_pdf(toolbox: list[list[tuple[str, str]]], tagger: Tagger, workers: int, name: str | None, scratch: str, on_stage: Callable[[str], None] | None = None, key: str | None = None, shards: int = 1, metrics: BuildMetrics | None = None, upload_hash: str | None = None) -> bytes:
+    # Everything is written to the request's own scratch directory, never the working directory.
+    on_stage = on_stage or (lambda stage: None)
+    metrics = metrics or BuildMetrics()
+    dictionary, loaded = get_dictionary(toolbox, tagger, workers, name, on_stage, metrics, upload_hash)
+    on_stage("rendering LaTeX")
+    tex_files = write_latex(dictionary, scratch, shards, kept(upload_hash, loaded))
+    metrics.count("rendering LaTeX", headings=sum(1 for heading in dictionary.entries if heading), shards=len(tex_files), latex_bytes=sum(os.path.getsize(tex_file) for tex_file in tex_files))
+    keep_dictionary(dictionary, tagger, name, on_stage, metrics, upload_hash, loaded)
+    artifacts = get_artifacts()
+    latex_key = file_hash(*tex_files)
+    if key is not None:
+        artifacts.link(key, latex_key)
+    # Edits that don't show in the dictionary (dates, line breaks, unused fields) render the same LaTeX.
+    pdf_file = artifacts.pdf_for_latex(latex_key)
+    if pdf_file is not None:
+        try:
+            with open(pdf_file, "rb") as f:
+                pdf = f.read()
+            metrics.count("compiling PDF", reused=1, pdf_bytes=len(pdf), pdf_pages=count_pages(pdf))
+            return pdf
+        except FileNotFoundError:
+            pass
+    on_stage("compiling PDF")
+    pdf = compile_shards(tex_files, scratch) if len(tex_files) > 1 else compile_latex(tex_files[0])
+    metrics.count("compiling PDF", pdf_bytes=len(pdf), pdf_pages=count_pages(pdf))
+    artifacts.put(latex_key, tex_files, pdf)
+    return pdf
+
+def build_preview(toolbox: list[list[tuple[str, str]]], tagger: Tagger, workers: int, name: str | None, output_file: str, format: str, on_stage: Callable[[str], None] | None = None, metrics: BuildMetrics | None = None, upload_hash: str | None = None, page_url: str = "?page={}") -> str:
+    # The HTML preview or the JSON export, written straight to `output_file` a heading at a time. No LaTeX, no pdflatex.
+    # The preview is written a page to a file (see jobs.page_path), each linking to the others at `page_url`.
+    on_stage = on_stage or (lambda stage: None)
+    metrics = metrics or BuildMetrics()
+    dictionary, loaded = get_dictionary(toolbox, tagger, workers, name, on_stage, metrics, upload_hash)
+    stage = f"rendering {format.upper()}"
+    on_stage(stage)
+    if format == "html":
+        pages = dictionary.html_pages(env.PREVIEW_PAGE_SIZE)
+        output_files = [page_path(output_file, page) for page in range(1, len(pages) + 1)]
+        for page, page_file in enumerate(output_files, 1):
+            with open(page_file, "w", encoding="utf-8") as f:
+                dictionary.write_html(f, pages, page, name or "Dictionary", page_url)
+    else:
+        output_files = [output_file]
+        with open(output_file, "w", encoding="utf-8") as f:
+            dictionary.write_json(f)
+    metrics.count(stage, headings=sum(1 for heading in dictionary.entries if heading), pages=len(output_files), output_bytes=sum(os.path.getsize(page_file) for page_file in output_files))
+    keep_dictionary(dictionary, tagger, name, on_stage, metrics, upload_hash, loaded)
+    return output_file
+
+def finish_from_cache(job: Job, jobs: JobStore, key: str) -> bool:
+    # An upload we have built before is done as soon as its PDF is copied over.
+    pdf_file = get_artifacts().pdf_for_upload(key)
+    if pdf_file is None:
+        return False
+    try:
+        job.finish(output_file=shutil.copyfile(pdf_file, jobs.output_file(job)))
+    except FileNotFoundError:
+        return False
+    report(job, "cached")
+    return True
+
+def report(job: Job, outcome: str, **fields):
+    log_build({
+        "event": "build",
+        "job": job.id,
+        "file": job.name,
+        "format": job.format,
+        "outcome": outcome,
+        "error": type(job.error).__name__ if job.error is not None else None,
+        "elapsed": round(job.finished - job.created, 3) if job.finished is not None else None,
+        **fields,
+        "process_peak_rss_kib": process_peak_rss_kib(),
+        "stages": job.metrics.snapshot(),
+    })
+
+def run_job(job: Job, jobs: JobStore, toolbox: list[list[tuple[str, str]]], tagger: Tagger, workers: int, key: str | None = None, shards: int = 1, profile_dir: str | None = None, upload_hash: str | None = None):
+    # Whatever goes wrong ends up on the job, for whoever is waiting on it or polling it.
+    profiler = cProfile.Profile() if profile_dir else None
+    try:
+        if profiler is not None:
+            profiler.enable()
+        if job.format == "pdf":
+            with tempfile.TemporaryDirectory(prefix="arok-", dir=env.SCRATCH_DIR) as scratch:
+                pdf = build_pdf(toolbox, tagger, workers, job.name, scratch, job.enter, key, shards, job.metrics, upload_hash)
+            job.finish(output_file=jobs.save_pdf(job, pdf))
+        else:
+            job.finish(output_file=build_preview(toolbox, tagger, workers, job.name, jobs.output_file(job), job.format, job.enter, job.metrics, upload_hash, f"/jobs/{job.id}/{job.format}?page={{}}"))
+    except Exception as e:
+        job.finish(error=e)
+    finally:
+        if profiler is not None and profile_dir is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(profile_dir, f"{job.id}.prof"))
+    report(job, job.state, tagger=tagger.name, shards=shards, profile=os.path.join(profile_dir, f"{job.id}.prof") if profile_dir else None)
+
+def describe_error(e: Exception) -> str:
+    if isinstance(e, LatexBuildError):
+        text = "There were issues on the file. Send a copy to altlab of the input files.\n\n\n"
+        for err in e.get_errors():
+            text += "{}\n\t{}\n".format(err["error"],err["context"][1])
+        return text
+    if isinstance(e, ValueError):
+        text = "Your toolbox file has some formatting issues.  This is the error we detected:\n\n\n"
+        text += "{}\n\n".format(str(e))
+        if "debug_info" in dir(e):
+            text += "The problem is in the following entry, which likely has more information, but we had to stop parsing it from the issue we just mentioned.\n\n"
+            text += e.debug_info # type: ignore
+            text += "\n{}\n{}\n".format(e.last_line,"^"*len(e.last_line)) # type: ignore
+        return text + "\n\n"
+    return f"The build failed: {e!r}. Send a copy to altlab of the input files.\n"
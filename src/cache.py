@@ -0,0 +1,246 @@
+"""
+cache.py: Persistent caches shared between builds (and between server workers).
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+def normalize_sentence(sentence: str) -> str:
+    # CoreNLP tokens never carry whitespace, so runs of it can't change the tagging.
+    return ' '.join(sentence.split())
+
+class SqliteCache:
+    """
+    Backed by sqlite so several server processes can share one file; each thread gets its own connection.
+    Once what is stored goes over `max_bytes`, the least recently used entries are dropped.
+    """
+
+    def __init__(self, path: str | os.PathLike, max_bytes: int):
+        self.path = os.fspath(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.local = threading.local()
+        self.counter_lock = threading.Lock()
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+    def connection(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+        return db
+
+    def count(self, hit: bool):
+        with self.counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+class TagCache(SqliteCache):
+    """Content-addressed store of tagging results, keyed on the normalized sentence and the tagger config."""
+
+    def __init__(self, path: str | os.PathLike, config: str, max_bytes: int):
+        super().__init__(path, max_bytes)
+        self.config = config
+        with self.connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS tags (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS tags_last_used ON tags (last_used)")
+        # What is stored, as far as this process knows: more than that when puts replace entries, less when other
+        # processes add some. Only once it goes over max_bytes does evict() sum up the table to know for sure.
+        self.stored = self.size()
+
+    def key(self, sentence: str) -> str:
+        return hashlib.sha256(f"{self.config}\0{normalize_sentence(sentence)}".encode("utf-8")).hexdigest()
+
+    def get_many(self, sentences: list[str]) -> dict[str, list[tuple[str,str,str]]]:
+        keys: dict[str, list[str]] = dict()
+        for sentence in sentences:
+            keys.setdefault(self.key(sentence), []).append(sentence)
+        found = dict()
+        db = self.connection()
+        key_list = list(keys)
+        now = time.time()
+        with db:
+            # Stay under sqlite's limit on bound parameters.
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i:i+500]
+                marks = ','.join('?' * len(chunk))
+                rows = db.execute(f"SELECT key, value FROM tags WHERE key IN ({marks})", chunk).fetchall()
+                for key, value in rows:
+                    tokens = [tuple(token) for token in json.loads(value)]
+                    for sentence in keys[key]:
+                        found[sentence] = tokens
+                if rows:
+                    db.execute(f"UPDATE tags SET last_used = ? WHERE key IN ({marks})", [now, *chunk])
+        hits = sum(1 for sentence in sentences if sentence in found)
+        with self.counter_lock:
+            self.hits += hits
+            self.misses += len(sentences) - hits
+        return found
+
+    def put_many(self, tagged: dict[str, list[tuple[str,str,str]]]):
+        if not tagged:
+            return
+        now = time.time()
+        rows = []
+        for sentence, tokens in tagged.items():
+            value = json.dumps(tokens, ensure_ascii=False)
+            rows.append((self.key(sentence), value, len(value), now))
+        db = self.connection()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO tags (key, value, size, last_used) VALUES (?, ?, ?, ?)", rows)
+        with self.counter_lock:
+            self.stored += sum(row[2] for row in rows)
+            full = self.stored > self.max_bytes
+        if full:
+            self.evict()
+
+    def size(self) -> int:
+        return self.connection().execute("SELECT COALESCE(SUM(size), 0) FROM tags").fetchone()[0]
+
+    def evict(self):
+        total = self.size()
+        if total <= self.max_bytes:
+            with self.counter_lock:
+                self.stored = total
+            return
+        db = self.connection()
+        with db:
+            # Trim to 90% so we aren't evicting again on the very next put.
+            excess = total - self.max_bytes * 9 // 10
+            freed = 0
+            stale = []
+            for key, size in db.execute("SELECT key, size FROM tags ORDER BY last_used"):
+                if freed >= excess:
+                    break
+                stale.append((key,))
+                freed += size
+            db.executemany("DELETE FROM tags WHERE key = ?", stale)
+        with self.counter_lock:
+            self.stored = total - freed
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.size()}
+
+def content_hash(*parts: str | bytes) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8") if isinstance(part, str) else part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def file_hash(*files: str) -> str:
+    # The same as content_hash of the files' contents, read a chunk at a time.
+    digest = hashlib.sha256()
+    for name in files:
+        with open(name, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class ArtifactCache(SqliteCache):
+    """
+    The LaTeX and PDF of finished builds, kept as files in `directory` and named by the hash of the LaTeX.
+
+    Uploads are mapped to the LaTeX they produced, so a repeated upload finds its PDF without building
+    anything, and a different upload that renders to the same LaTeX doesn't run pdflatex again.
+    """
+
+    def __init__(self, directory: str | os.PathLike, max_bytes: int):
+        self.directory = os.fspath(directory)
+        super().__init__(os.path.join(self.directory, "index.sqlite3"), max_bytes)
+        with self.connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS uploads (key TEXT PRIMARY KEY, latex TEXT NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS uploads_latex ON uploads (latex)")
+            db.execute("CREATE TABLE IF NOT EXISTS artifacts (latex TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS artifacts_last_used ON artifacts (last_used)")
+        # As in TagCache, summed up again only when it goes over max_bytes.
+        self.stored = self.size()
+
+    def file(self, latex_key: str, suffix: str) -> str:
+        return os.path.join(self.directory, latex_key + suffix)
+
+    def pdf_for_latex(self, latex_key: str) -> str | None:
+        db = self.connection()
+        with db:
+            found = db.execute("UPDATE artifacts SET last_used = ? WHERE latex = ?", (time.time(), latex_key)).rowcount > 0
+        pdf_file = self.file(latex_key, ".pdf")
+        hit = found and os.path.exists(pdf_file)
+        self.count(hit)
+        return pdf_file if hit else None
+
+    def pdf_for_upload(self, key: str) -> str | None:
+        row = self.connection().execute("SELECT latex FROM uploads WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.count(False)
+            return None
+        return self.pdf_for_latex(row[0])
+
+    def link(self, key: str, latex_key: str):
+        db = self.connection()
+        with db:
+            db.execute("INSERT OR REPLACE INTO uploads (key, latex) VALUES (?, ?)", (key, latex_key))
+
+    def put(self, latex_key: str, tex_files: list[str], pdf: bytes):
+        # The LaTeX is copied over from the build's files, shards one after the other.
+        size = 0
+        for suffix in (".tex", ".pdf"):
+            # Written aside and moved in place, so nobody ever reads half a file.
+            partial = self.file(latex_key, f"{suffix}.{os.getpid()}.{threading.get_ident()}")
+            with open(partial, "wb") as f:
+                if suffix == ".pdf":
+                    f.write(pdf)
+                else:
+                    for name in tex_files:
+                        with open(name, "rb") as tex:
+                            shutil.copyfileobj(tex, f)
+                size += f.tell()
+            os.replace(partial, self.file(latex_key, suffix))
+        db = self.connection()
+        with db:
+            db.execute("INSERT OR REPLACE INTO artifacts (latex, size, last_used) VALUES (?, ?, ?)", (latex_key, size, time.time()))
+        with self.counter_lock:
+            self.stored += size
+            full = self.stored > self.max_bytes
+        if full:
+            self.evict()
+
+    def size(self) -> int:
+        return self.connection().execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+
+    def evict(self):
+        total = self.size()
+        if total <= self.max_bytes:
+            with self.counter_lock:
+                self.stored = total
+            return
+        db = self.connection()
+        with db:
+            excess = total - self.max_bytes * 9 // 10
+            freed = 0
+            stale = []
+            for latex_key, size in db.execute("SELECT latex, size FROM artifacts ORDER BY last_used"):
+                if freed >= excess:
+                    break
+                stale.append((latex_key,))
+                freed += size
+            db.executemany("DELETE FROM artifacts WHERE latex = ?", stale)
+            db.executemany("DELETE FROM uploads WHERE latex = ?", stale)
+        with self.counter_lock:
+            self.stored = total - freed
+        for (latex_key,) in stale:
+            for suffix in (".tex", ".pdf"):
+                if os.path.exists(self.file(latex_key, suffix)):
+                    os.remove(self.file(latex_key, suffix))
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.size()}
@@ -1,87 +1,31 @@
+import argparse
+from resolve import DateOnlyEnding, KeepFields, Resolver, Rule
+
 DIFF_SRC="../data/Wolvengrey_altlab_diff.toolbox"
 DIFF_OUTPUT="../data/Wolvengrey_altlab_output.toolbox"
-LEFT="HEAD"
-RIGHT="master"
 # The key of this file is to process automagically all the changes we already made and which should have been auto merged but for which it seems that git is very dumb (or should have been done with dates?)  I can't really trust merges now it seems
 
-chunks = []
-lines = []
-
-# split diffs into chunks
-
-with open(DIFF_SRC,'r+') as f:
-    for line in f:
-        if line != f"<<<<<<< {LEFT}\n":
-            lines.append(line)
-        else:
-            chunks.append({"diff": False, "lines": lines})
-            lines = []
-            left = []
-            next_line = next(f)
-            while (next_line != "=======\n"):
-                left.append(next_line)
-                next_line = next(f)
-            next_line = next(f)
-            right = []
-            while (next_line != f">>>>>>> {RIGHT}\n"):
-                right.append(next_line)
-                next_line = next(f)
-            chunks.append({"diff": True, "left": left, "right": right})
-    if lines:
-        chunks.append({"diff": False, "lines": lines})
-
-diffs = [x for x in chunks if x['diff']]
-
-starts = [
-    "\\rw",
-    "\\rw2",
-    "\\wn"
-]
-
-def drop_rw(lines):
-    return [l for l in lines if not any([l.startswith(s+" ") or l == s+"\n" for s in starts])]
-
-def keep_rw(lines):
-    return [l for l in lines if any([l.startswith(s+" ") or l == s+"\n" for s in starts])]
-
-keys = set()
-
-def collect(x : list[str]):
-    keys.update([l.partition(" ")[0] for l in x])
-    return True
-
-def was_rw(chunk):
-    return chunk["diff"] and not chunk["right"] and collect(chunk["left"])
-
-def new_ending(chunk):
-    return chunk["diff"] and all([x.startswith("\\dt ") for x in drop_rw(chunk["left"])]) and all([x.startswith("\\dt ") for x in drop_rw(chunk["left"])])
-
-
-print(f"Chunks: {len(diffs)}")
-print(f"Was_rw:{len([d for d in diffs if was_rw(d)])}")
-print(f"New_end:{len([d for d in diffs if new_ending(d)])}")
-print(f"KEYS: {keys}")
-print("\n\n")
-
-with open(DIFF_OUTPUT,'w') as f:
-    for chunk in chunks:
-        if not chunk["diff"]:
-            for line in chunk["lines"]:
-                f.write(line)
-        elif new_ending(chunk):
-            if chunk["right"]:
-                for line in keep_rw(chunk["left"]):
-                    f.write(line)
-                for line in drop_rw(chunk["right"]):
-                    f.write(line)
-            else:
-                for line in chunk["left"]:
-                    f.write(line)
-        else:
-            f.write(f"<<<<<<< {LEFT}\n")
-            for line in chunk["left"]:
-                f.write(line)
-            f.write("=======\n")
-            for line in chunk["right"]:
-                f.write(line)
-            f.write(f">>>>>>> {RIGHT}\n")
+# The fields added at the end of entries on one side, while the other side only changed their date.
+MOVED_FIELDS = ["\\rw", "\\rw2", "\\wn"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resolve the merge conflicts of a toolbox file that follow known patterns, and leave the rest.")
+    parser.add_argument("--input", default=DIFF_SRC)
+    parser.add_argument("--output", default=DIFF_OUTPUT)
+    parser.add_argument("--moved-fields", nargs="+", default=MOVED_FIELDS,
+                        help="Fields the left side adds to entries whose ending otherwise only differs in the date.")
+    parser.add_argument("--keep-left", nargs="+", default=[], metavar="FIELD",
+                        help="When both sides only differ in these fields, keep the left side.")
+    parser.add_argument("--keep-right", nargs="+", default=[], metavar="FIELD",
+                        help="When both sides only differ in these fields, keep the right side.")
+    args = parser.parse_args()
+
+    rules: list[Rule] = [DateOnlyEnding(set(args.moved_fields))]
+    if args.keep_left:
+        rules.append(KeepFields(set(args.keep_left), "left"))
+    if args.keep_right:
+        rules.append(KeepFields(set(args.keep_right), "right"))
+    resolver = Resolver(rules)
+    with open(args.input) as f, open(args.output, "w") as output:
+        resolver.resolve(f, output)
+    print(resolver.summary())
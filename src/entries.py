@@ -1,13 +1,20 @@
 """
 entries.py: Provides both the helper functions and the main function to process the dictionary and definitions for them.
 """
+import json
+from jinja2 import Environment
 from jinja2.loaders import FileSystemLoader
 from latex.jinja2 import make_env
-from parse import so_far_collected
-from stanford import tag_sentences
-from operator import itemgetter, attrgetter
+from parse import check_line, iter_lines, read_header, so_far_collected
+from taggers import Tagger, get_tagger
+import env as config
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import natsort
+import re
 from natsort.ns_enum import ns
+from typing import Callable, Iterable, Iterator, TextIO
 
 def check_data (data, entry):
     fields = data.keys()
@@ -17,77 +24,115 @@ def check_data (data, entry):
         err.last_line="" # type:ignore
         raise err        
 
+# Fields populate_fields can't do without.
+REQUIRED_FIELDS = ("\\sro", "\\syl", "\\ps", "\\stm", "\\def")
+
+def validate_toolbox(data) -> tuple[int, list[dict]]:
+    """
+    How many entries a toolbox file (anything parse.iter_lines reads) has, and every formatting error
+    in it as {"line", "error"}: what parsing and building the entries would stop at, one at a time.
+    One pass over the lines. Entries without formatting errors are built, so whatever else building
+    them would stop at is reported too, but nothing is tagged.
+    """
+    errors: list[dict] = []
+    f = iter_lines(data)
+    try:
+        read_header(f)
+    except ValueError as e:
+        errors.append({"line": 1, "error": str(e)})
+    entries = 0
+    entry: list[tuple[str, str]] = []
+    start = 3
+    reported = len(errors)
+    def finish():
+        fields = {key for key, _ in entry}
+        if not fields:
+            return 0
+        try:
+            check_data(dict.fromkeys(fields), entry)
+        except ValueError as e:
+            errors.append({"line": start, "error": str(e)})
+        for field in REQUIRED_FIELDS[1:]:
+            if field not in fields:
+                errors.append({"line": start, "error": f"The entry on line {start} is missing the {field} field."})
+        if len(errors) == reported:
+            try:
+                TBEntry(entry).scans
+            except Exception as e:
+                errors.append({"line": start, "error": f"The entry on line {start} could not be built: {e!r}"})
+        return 1
+    for linenum, line in enumerate(f, 3):
+        if not line.strip():
+            entries += finish()
+            entry = []
+            start = linenum + 1
+            reported = len(errors)
+            continue
+        candidate = line.strip().partition(" ")
+        err = check_line(candidate, line, linenum, entry)
+        if err is not None:
+            errors.append({"line": linenum, "error": str(err)})
+            continue
+        if candidate[0] == "\\glp" and candidate[2].strip():
+            before, separator, after = candidate[2].partition("-")
+            if not separator:
+                errors.append({"line": linenum, "error": f"Line {linenum} has a \\glp field without the - that separates the heading from the subheading: {candidate[2]}"})
+            elif not before.strip() or not after.strip():
+                errors.append({"line": linenum, "error": f"Line {linenum} has a \\glp field with nothing on one side of the - that separates the heading from the subheading: {candidate[2]}"})
+        entry.append((candidate[0], candidate[2]))
+    entries += finish()
+    errors.sort(key=lambda error: error["line"])
+    return entries, errors
+
 def expand_conventions(defn: str)-> str:
     return defn.replace("s.o.","someone").replace("s.t.","something").replace("S/he","she").replace("s/he","she")
 
+def expand_conventions_batch(senses: Iterable[str]) -> dict[str, str]:
+    # Every distinct sense once, in a single pass over all of them. Senses come from single lines, so "\n" can't be in one.
+    unique = list(dict.fromkeys(senses))
+    return dict(zip(unique, expand_conventions("\n".join(unique)).split("\n")))
+
 class TBEntry:
+    """
+    One toolbox entry. Only what every build reads is computed up front; the split
+    definitions and their canonical forms are worked out on first access, and
+    drop_derived() releases them (and the tagger output) once the build is done with them.
+    """
+    __slots__ = (
+        "original_data", "sro", "syllabics", "pos", "stem", "date", "definitions",
+        "glosses", "latex_pos", "latex_stem", "parsed_subsenses", "processed_subsenses",
+        "_scans",
+        "matches",
+    )
 
     def __init__(self, original_data: list[tuple[str, str]]):
         self.original_data = original_data
-        self.original_dict = dict()
-        for key, value in original_data:
-            self.original_dict.setdefault(key,[]).append(value)
+        self._scans: list[tuple[list[str], list[str], str]] | None = None
+        # For each heading or subheading the entry is glossed under, its senses that mention it, split around it.
+        self.matches: dict[str, list[tuple[str,str,str]]] = dict()
         self.populate_fields()
-    
-    def populate_fields(self):
-        check_data(self.original_dict, self.original_data)
-        self.sro = self.original_dict["\\sro"]
-        self.syllabics = self.original_dict["\\syl"]
-        self.pos = self.original_dict["\\ps"]
-        self.stem = self.original_dict.get("\\stm", [])
-        self.date = self.original_dict.get("\\dt",[])
-        self.level_annotated_defns = [
-            annotate_nesting_levels(defn)
-            for defn in self.original_dict["\\def"]
-        ]
-
-        self.level_annotated_senses = [
-            x 
-            for defn in self.level_annotated_defns
-            for x in nested_split(defn, ";")
-        ]
-        self.level_annotated_subsenses = [
-            x
-            for sense in self.level_annotated_senses
-            for x in nested_split(sense, ",")
-        ]
-        self.definitions = [
-            ''.join([x[1] for x in lad])
-            for lad in self.level_annotated_defns
-        ]
-        self.senses = [
-            ''.join([x[1] for x in las])
-            for las in self.level_annotated_senses
-        ]
 
-        self.subsenses = [
-            ''.join([x[1] for x in lass])
-            for lass in self.level_annotated_subsenses
-        ]
+    @property
+    def original_dict(self) -> dict[str, list[str]]:
+        original_dict = dict()
+        for key, value in self.original_data:
+            original_dict.setdefault(key,[]).append(value)
+        return original_dict
 
-        self.subsenses_expanded = [
-            expand_conventions(sense) for sense in self.subsenses
-        ]
+    def populate_fields(self):
+        original_dict = self.original_dict
+        check_data(original_dict, self.original_data)
+        self.sro = original_dict["\\sro"]
+        self.syllabics = original_dict["\\syl"]
+        self.pos = original_dict["\\ps"]
+        self.stem = original_dict.get("\\stm", [])
+        self.date = original_dict.get("\\dt",[])
+        self.definitions = original_dict["\\def"]
 
         self.parsed_subsenses: list[list[tuple[str,str,str]]] = []
         
         self.processed_subsenses: list[str] = []
 
-        self.canonicalized_definitions = [
-            drop_nested(x).strip()
-            for x in self.level_annotated_defns
-        ]
-
-        self.canonicalized_senses = [
-            drop_nested(x).strip()
-            for x in self.level_annotated_senses
-        ]
-
-        self.canonicalized_subsenses = [
-            drop_nested(x).strip()
-            for x in self.level_annotated_subsenses
-        ]
-
         gloss_data = filter(lambda x: x[0].startswith("\\gl"), self.original_data)
         self.glosses = []
         main_entry = []
@@ -110,127 +155,462 @@ class TBEntry:
         if not self.latex_stem:
             self.latex_stem = self.sro[0].strip()
 
-def build_basic_tbentries(data : list[list[tuple[str, str]]]) -> list[TBEntry]:
-    return [TBEntry(x) for x in data if next(filter(lambda y: y[0] != "line", x), None) is not None]
+    @property
+    def scans(self) -> list[tuple[list[str], list[str], str]]:
+        # One scan per definition gives its senses, subsenses and top-level-only form.
+        if self._scans is None:
+            self._scans = [scan_definition(defn) for defn in self.definitions]
+        return self._scans
+
+    @property
+    def senses(self) -> list[str]:
+        return [sense for senses, _, _ in self.scans for sense in senses]
+
+    @property
+    def subsenses(self) -> list[str]:
+        return [subsense for _, subsenses, _ in self.scans for subsense in subsenses]
+
+    @property
+    def subsenses_expanded(self) -> list[str]:
+        return [expand_conventions(sense) for sense in self.subsenses]
+
+    @property
+    def canonicalized_definitions(self) -> list[str]:
+        return [canonical.strip() for _, _, canonical in self.scans]
+
+    # Separators only survive in the canonical form when they are at the top level,
+    # so splitting it again gives the canonical form of each sense and subsense.
+    @property
+    def canonicalized_senses(self) -> list[str]:
+        return [
+            sense.strip()
+            for _, _, canonical in self.scans
+            for sense in canonical.split(";")
+        ]
+
+    @property
+    def canonicalized_subsenses(self) -> list[str]:
+        return [
+            subsense.strip()
+            for _, _, canonical in self.scans
+            for sense in canonical.split(";")
+            for subsense in sense.split(",")
+        ]
+
+    # A flat tuple pickles much faster than the default per-slot state when entries come back from workers.
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in TBEntry.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(TBEntry.__slots__, state):
+            setattr(self, slot, value)
+
+    def drop_derived(self):
+        # Everything here can be recomputed from definitions if it is asked for again.
+        self._scans = None
+        self.parsed_subsenses = []
+
+def has_fields(data: list[tuple[str, str]]) -> bool:
+    return next(filter(lambda y: y[0] != "line", data), None) is not None
+
+def build_tbentry_states(data : list[list[tuple[str, str]]]) -> list[tuple]:
+    # Runs in a worker. The definitions get split here too so that work is shared out as well,
+    # and original_data is left out since the parent already has it.
+    states = []
+    for x in data:
+        entry = TBEntry(x)
+        entry.scans
+        entry.original_data = []
+        states.append(entry.__getstate__())
+    return states
+
+def build_basic_tbentries(data : list[list[tuple[str, str]]], workers: int = 1) -> list[TBEntry]:
+    if workers <= 1:
+        return [TBEntry(x) for x in data if has_fields(x)]
+    data = [x for x in data if has_fields(x)]
+    # A few chunks per worker balances the load, big enough chunks keep pickling overhead down.
+    chunk_size = max(config.MIN_CHUNK_SIZE, -(-len(data) // (workers * 4)))
+    if len(data) <= chunk_size:
+        return [TBEntry(x) for x in data]
+    chunks = [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
+    entries = []
+    # Workers are started from a clean process: forking the server would copy its threads' locks in whatever state they are.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver")) as pool:
+        # map keeps the original order, and raises the first failing chunk's error just like the serial loop would.
+        states = (state for chunk_states in pool.map(build_tbentry_states, chunks) for state in chunk_states)
+        for original_data, state in zip(data, states):
+            entry = TBEntry.__new__(TBEntry)
+            entry.__setstate__(state)
+            entry.original_data = original_data
+            entries.append(entry)
+    return entries
 
-def annotate_nesting_levels( data: str, nest_increase=["(","["], nest_decrease=[")","]"]) -> list[tuple[int,str]]:
-    # Note that this method does not check that parenthesis are properly balanced,
-    # as this is only going to be used to keep the main level anyways.
+_NESTING = re.compile(r"[(\[)\]]")
+_SEPARATORS = re.compile(r"[;,]")
+
+def scan_definition(defn: str) -> tuple[list[str], list[str], str]:
+    """
+    Splits a definition into senses (on top-level ";") and subsenses (on top-level ","),
+    and drops everything nested, in one pass over its brackets and separators.
+    Gives the same result as the per-character annotate_nesting_levels, nested_split and drop_nested in bench.py:
+    an opening bracket is itself nested, a closing bracket back to the top level is not.
+    """
+    # Runs of characters at the top level, as (start, end) offsets.
+    top_level = []
     level = 0
-    def calc_level(char):
-        nonlocal level
-        if char in nest_increase:
-            level += 1
-        elif char in nest_decrease:
-            level -= 1
-        return level
-    return [ (calc_level(char), char) for char in data ]
-
-def nested_split ( nested_data: list[tuple[int,str]], char: str, level=0 ) -> list[list[tuple[int,str]]]:
-    split = []
-    current = []
-    for data in nested_data:
-        if data == (level, char):
-            split.append(current)
-            current=[]
-        else:
-            current.append(data)
-    split.append(current)
-    return split
+    start = 0
+    for match in _NESTING.finditer(defn):
+        i = match.start()
+        if level == 0 and start < i:
+            top_level.append((start, i))
+        level += 1 if defn[i] in "([" else -1
+        start = i if level == 0 else i + 1
+    if level == 0 and start < len(defn):
+        top_level.append((start, len(defn)))
 
-def drop_nested( original_annotated_nesting: list[tuple[int,str]]) -> str:
-    return ''.join([
-        x[1]
-        for x in original_annotated_nesting
-        if x[0] == 0
-    ])
+    senses = []
+    subsenses = []
+    sense_start = subsense_start = 0
+    for run_start, run_end in top_level:
+        for match in _SEPARATORS.finditer(defn, run_start, run_end):
+            i = match.start()
+            subsenses.append(defn[subsense_start:i])
+            if defn[i] == ";":
+                senses.append(defn[sense_start:i])
+                sense_start = i + 1
+            subsense_start = i + 1
+    senses.append(defn[sense_start:])
+    subsenses.append(defn[subsense_start:])
+    return senses, subsenses, ''.join(defn[run_start:run_end] for run_start, run_end in top_level)
 
 env = make_env(loader=FileSystemLoader("./templates"))
+html_env = Environment(loader=FileSystemLoader("./templates"), autoescape=True)
+
+def match_senses(entry: TBEntry, needles: set[str]):
+    # One partition per sense both finds the needle and splits around it.
+    entry.matches = dict()
+    for needle in needles:
+        # An empty heading (from a \\glp with nothing after its -) is in every sense, and can't split any.
+        if not needle:
+            continue
+        entry.matches[needle] = [split for split in (sense.partition(needle) for sense in entry.processed_subsenses) if split[1]]
+
+def escape_latex(text: str) -> str:
+    return text.replace("&","\\&").replace("{","\\{").replace("}","\\}").replace("#","\\#").replace("$","\\$")
+
+# Escaped parts of split senses, filled a whole build at a time by escape_latex_batch.
+_escaped: dict[str, str] = dict()
 
-def simplify_defns(remove:str, entry: TBEntry) -> list[tuple[str,str,str]]:
-    defns = [defn for defn in entry.processed_subsenses if remove in defn]
-   
-    return [defn.partition(remove) for defn in defns]
+def escape_latex_batch(texts: Iterable[str]):
+    new = [text for text in dict.fromkeys(texts) if text not in _escaped]
+    if len(_escaped) + len(new) > config.ESCAPE_CACHE_SIZE:
+        _escaped.clear()
+    # Split senses come from single lines, so escaping them all joined by "\n" escapes each one.
+    _escaped.update(zip(new, (text.strip() for text in escape_latex("\n".join(new)).split("\n"))))
+
+# Where the heading was in a sense, once it is taken out.
+TILDE = "{\\raisebox{-.25em}{\\textasciitilde}} "
 
 def canonicalize_defn(parts: tuple[str,str,str]) -> str:
     def chunk(parts: list[str]) -> str:
         if parts[1]:
             if parts[0] or parts[2]:
-                return "{\\raisebox{-.25em}{\\textasciitilde}} ".join([parts[0],parts[2]])
+                return TILDE.join([parts[0],parts[2]])
             return ""
         return parts[0]
     
-    return chunk([x.replace("&","\\&").replace("{","\\{").replace("}","\\}").replace("#","\\#").replace("$","\\$").strip()
-                  for x in parts])
+    return chunk([_escaped.get(x) or escape_latex(x).strip() for x in parts])
+
+def plain_defn(parts: tuple[str,str,str]) -> str:
+    # canonicalize_defn as plain text, for anything that isn't LaTeX: made from the split sense itself, never from the LaTeX.
+    before, heading, after = (x.strip() for x in parts)
+    if heading:
+        return "~ ".join([before, after]) if before or after else ""
+    return before
+
+class GlossNode:
+    """
+    A heading, or a subheading of one, in the gloss tree: the entries glossed with it and its
+    subheadings, both in the order they were first seen.
+    """
+    __slots__ = ("key", "entries", "children")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.entries: list[TBEntry] = []
+        self.children: dict[str, GlossNode] = dict()
 
-ESCAPED_KEY = "itwewina_entries"
+    def child(self, key: str) -> "GlossNode":
+        node = self.children.get(key)
+        if node is None:
+            node = self.children[key] = GlossNode(key)
+        return node
 
-def sort_main_entries(entries: list[tuple[tuple[str,str,str],TBEntry]]) -> list[tuple[str,TBEntry]]:
-    candidates = natsort.natsorted(entries,key=lambda x: x[0][2],alg=ns.NUMAFTER | ns.GROUPLETTERS | ns.LOWERCASEFIRST)
-    candidates = natsort.natsorted(candidates,key=lambda x: x[0][0],alg=ns.NUMAFTER | ns.GROUPLETTERS | ns.LOWERCASEFIRST)
-    return [(canonicalize_defn(split_defn), entry) for split_defn, entry in candidates]
+    def matches(self, needle: str) -> list[tuple[tuple[str,str,str], TBEntry]]:
+        return [(split, entry) for entry in self.entries for split in entry.matches.get(needle, ())]
+
+    def weight(self) -> int:
+        # Roughly the lines a heading takes on the page: the heading, its entries and those of its subheadings.
+        return 1 + len(self.entries) + sum(len(child.entries) for child in self.children.values())
+
+    def same_as(self, other: "GlossNode | None") -> bool:
+        # Same subheadings in the same order, and the very same entry objects in the same order.
+        if other is None or len(self.entries) != len(other.entries) or list(self.children) != list(other.children):
+            return False
+        if any(x is not y for x, y in zip(self.entries, other.entries)):
+            return False
+        return all(child.same_as(other.children[key]) for key, child in self.children.items())
+
+NATSORT_ALG = ns.NUMAFTER | ns.GROUPLETTERS | ns.LOWERCASEFIRST
+_natsort_key = natsort.natsort_keygen(alg=NATSORT_ALG)
+
+# The same headings and definitions get sorted over and over while building a dictionary,
+# so each string's natsort key is only worked out once.
+# Sorting once on (first, second) gives the same order as natsorting on second and then on first.
+@lru_cache(maxsize=config.SORT_KEY_CACHE_SIZE)
+def natural_key(text: str):
+    return _natsort_key(text)
+
+def sort_main_entries(entries: list[tuple[tuple[str,str,str],TBEntry]], defn: Callable[[tuple[str,str,str]], str] = canonicalize_defn) -> list[tuple[str,TBEntry]]:
+    candidates = sorted(entries, key=lambda x: (natural_key(x[0][0]), natural_key(x[0][2])))
+    return [(defn(split_defn), entry) for split_defn, entry in candidates]
 
 def sort_subheading_keys(entries: list[str], heading: str) -> list[str]:
     candidates = [entry.partition(heading) for entry in entries]
-    candidates = natsort.natsorted(candidates,key=itemgetter(2),alg=ns.NUMAFTER | ns.GROUPLETTERS | ns.LOWERCASEFIRST)
-    candidates = natsort.natsorted(candidates,key=itemgetter(0),alg=ns.NUMAFTER | ns.GROUPLETTERS | ns.LOWERCASEFIRST)
+    candidates.sort(key=lambda x: (natural_key(x[0]), natural_key(x[2])))
 
     return [''.join(t) for t in candidates]
 
-def sort_subheading_entries(entries: list[tuple[tuple[str,str,str],TBEntry]]) -> list[tuple[str, TBEntry]]:
+def sort_subheading_entries(entries: list[tuple[tuple[str,str,str],TBEntry]], defn: Callable[[tuple[str,str,str]], str] = canonicalize_defn) -> list[tuple[str, TBEntry]]:
     # This looks like repeats sort_main_entries but we keep it separate in case we need to change it separately later
-    candidates = natsort.natsorted(entries,key=lambda x: x[0][2],alg=ns.NUMAFTER | ns.GROUPLETTERS | ns.LOWERCASEFIRST)
-    candidates = natsort.natsorted(candidates,key=lambda x: x[0][0],alg=ns.NUMAFTER | ns.GROUPLETTERS | ns.LOWERCASEFIRST)
-    return [(canonicalize_defn(split_defn), entry) for split_defn, entry in candidates]
+    candidates = sorted(entries, key=lambda x: (natural_key(x[0][0]), natural_key(x[0][2])))
+    return [(defn(split_defn), entry) for split_defn, entry in candidates]
 
 class DictEntry:
-    def __init__(self, heading, parsed_heading, data):
+    # `defn` writes each split sense out: as LaTeX, or as plain text for the previews.
+    def __init__(self, heading: str, parsed_heading: str, node: GlossNode, defn: Callable[[tuple[str,str,str]], str] = canonicalize_defn):
         self.head = heading
-        self.main_entries = sort_main_entries([(split_defn,entry) for entry in data.get(ESCAPED_KEY,[]) for split_defn in simplify_defns(parsed_heading, entry)])
-        self.subheading_keys = sort_subheading_keys([key for key in data.keys() if key != ESCAPED_KEY], heading)
+        self.main_entries = sort_main_entries(node.matches(parsed_heading), defn)
+        self.subheading_keys = sort_subheading_keys(list(node.children), heading)
         # Now you could sort the subheadings
         # But for now, we are keeping them as they come.
         self.subheadings = []
         for key in self.subheading_keys:
-            self.subheadings.append((key, sort_subheading_entries([(split_defn,entry) for entry in data[key].get(ESCAPED_KEY,[]) for split_defn in simplify_defns(key, entry)])))
+            self.subheadings.append((key, sort_subheading_entries(node.children[key].matches(key), defn)))
+
+
+def preview_entry(dictentry: DictEntry) -> dict:
+    # A heading as plain data, for the HTML preview and the JSON export, from a DictEntry made with plain_defn.
+    def entries(defns: list[tuple[str, TBEntry]]) -> list[dict]:
+        return [
+            {"definition": defn, "sro": entry.sro[0] if entry.sro else "", "stem": entry.latex_stem, "pos": entry.pos[0] if entry.pos else "", "definitions": entry.definitions}
+            for defn, entry in defns
+        ]
+    return {
+        "heading": dictentry.head,
+        "entries": entries(dictentry.main_entries),
+        "subheadings": [{"subheading": key, "entries": entries(defns)} for key, defns in dictentry.subheadings],
+    }
 
+def fingerprint(data: list[tuple[str, str]]) -> tuple[tuple[str, str], ...]:
+    # The fields themselves make an exact (and cheap to hash) key. Line numbers shift
+    # whenever anything above an entry changes, so they don't count.
+    return tuple(x for x in data if x[0] != "line")
 
 class Dictionary:
-    def __init__(self, data: list[list[tuple[str,str]]]):
+    """
+    The grouped and tagged dictionary. When built from a `previous` Dictionary (of the same
+    toolbox file, with the same tagger), entries whose fields haven't changed are reused as they are,
+    only new or edited entries and new headings are tagged, and the DictEntry of every heading
+    whose gloss subtree is unchanged is carried over. `on_stage` is called with the name of
+    each stage of the build as it starts.
+    """
+    def __init__(self, data: list[list[tuple[str,str]]], tagger: Tagger | None = None, workers: int | None = None, previous: "Dictionary | None" = None, on_stage: Callable[[str], None] | None = None):
+        on_stage = on_stage or (lambda stage: None)
+        on_stage("parsing")
         self.data = data
-        self.crkentries = build_basic_tbentries(data)
+        self.tagger = tagger or get_tagger(config.TAGGER)
+        workers = config.WORKERS if workers is None else workers
+        if previous is not None and previous.tagger.name != self.tagger.name:
+            previous = None
+        if previous is None:
+            self.crkentries = build_basic_tbentries(data, workers)
+            self.fingerprints = [fingerprint(entry.original_data) for entry in self.crkentries]
+            new_entries = self.crkentries
+        else:
+            new_entries = self.reuse_entries(previous, data, workers)
+        # What the build went through, for the build metrics.
+        self.stats = {"entries": len(self.crkentries), "new_entries": len(new_entries)}
         # Group all entries by gloss
-        keys = set()
-        self.entries = dict()
+        on_stage("grouping")
+        self.entries: dict[str, GlossNode] = dict()
         for entry in self.crkentries:
             for gloss in entry.glosses:
-                current = self.entries
-                for index in gloss:
-                    current = current.setdefault(index, dict())
-                    keys.add(index)
-                current.setdefault(ESCAPED_KEY,[]).append(entry)
-        keys = list(keys)
-        parsed_keys = tag_sentences(keys)
-        self.parsed_keys = {unparsed:parsed_keys[key] for key, unparsed in enumerate(keys)}
-    
+                node = self.entries.get(gloss[0])
+                if node is None:
+                    node = self.entries[gloss[0]] = GlossNode(gloss[0])
+                for key in gloss[1:]:
+                    node = node.child(key)
+                node.entries.append(entry)
+        on_stage("tagging")
+        self.tag(new_entries, previous.parsed_keys if previous else {})
+        self.dictentries: dict[str, DictEntry] = dict()
+        if previous is not None:
+            for heading, body in self.entries.items():
+                if heading in previous.dictentries and body.same_as(previous.entries.get(heading)):
+                    self.dictentries[heading] = previous.dictentries[heading]
+
+    # Snapshots keep what the build made of the toolbox, not the toolbox itself nor the tagger (which may hold CoreNLP connections).
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["data"], state["tagger"]
+        return state
+
+    def reuse_entries(self, previous: "Dictionary", data: list[list[tuple[str,str]]], workers: int) -> list[TBEntry]:
+        unchanged: dict[tuple[tuple[str, str], ...], list[TBEntry]] = dict()
+        for key, entry in zip(previous.fingerprints, previous.crkentries):
+            unchanged.setdefault(key, []).append(entry)
+        for entries in unchanged.values():
+            entries.reverse()
+        # The entries in order, with None where one has to be built.
+        reused: list[TBEntry | None] = []
+        self.fingerprints = []
+        changed = []
+        for x in data:
+            if not has_fields(x):
+                continue
+            key = fingerprint(x)
+            self.fingerprints.append(key)
+            if unchanged.get(key):
+                entry = unchanged[key].pop()
+                # Same fields, but its line numbers may have moved.
+                entry.original_data = x
+                reused.append(entry)
+            else:
+                changed.append(x)
+                reused.append(None)
+        new_entries = build_basic_tbentries(changed, workers)
+        built = iter(new_entries)
+        self.crkentries = [entry if entry is not None else next(built) for entry in reused]
+        print(f"Incremental build: {len(new_entries)} new or changed entries, {len(previous.crkentries) - len(self.crkentries) + len(new_entries)} removed or changed.")
+        return new_entries
+
+    def tag(self, new_entries: list[TBEntry] | None = None, known_keys: dict[str, list[tuple[str,str,str]]] | None = None):
+        new_entries = self.crkentries if new_entries is None else new_entries
+        known_keys = known_keys or dict()
+        # Only top-level headings are ever looked up in parsed_keys.
+        keys = [key for key in self.entries if key and key not in known_keys]
+        expanded = expand_conventions_batch(subsense for entry in new_entries for subsense in entry.subsenses)
+        inflected_senses = list({sense for sense in expanded.values() if sense.strip()})
+        # Both passes go to the tagger in one call so their batches are dispatched concurrently.
+        parsed = self.tagger.tag(keys + inflected_senses) if keys or inflected_senses else []
+        self.stats["headings_tagged"] = len(keys)
+        self.stats["senses_tagged"] = len(inflected_senses)
+        self.parsed_keys = {key:known_keys[key] for key in self.entries if key in known_keys}
+        self.parsed_keys.update({unparsed:parsed[key] for key, unparsed in enumerate(keys)})
+        transfered_senses = {inflected:parsed[len(keys) + key] for key, inflected in enumerate(inflected_senses)}
+        self.picked_keys = {key:pick_sense(self.parsed_keys[key], key, None) for key in self.parsed_keys}
+        # Now that we have the data, we can actually provide the correct definitions to each sense
+        for entry in new_entries:
+            entry.parsed_subsenses = [transfered_senses[expanded[subsense]] for subsense in entry.subsenses if expanded[subsense].strip()]
+            entry.processed_subsenses = [pick_sense(parsed, entry.subsenses[i], entry) for i, parsed in enumerate(entry.parsed_subsenses)]
+            self.match_entry(entry)
+            # Rendering only needs the matches from here on.
+            entry.drop_derived()
+        escape_latex_batch(part for entry in new_entries for splits in entry.matches.values() for split in splits for part in split)
+
+    def match_entry(self, entry: TBEntry):
+        # Headings are looked for in the senses once, here, rather than every time a heading is put together.
+        needles = set()
+        for gloss in entry.glosses:
+            if gloss[0]:
+                needles.add(self.picked_keys[gloss[0]])
+                needles.update(gloss[1:2])
+        match_senses(entry, needles)
+
     def latex(self) -> str:
         data = env.get_template("dict.latex").render({"entries":self.context()})
         return data
 
+    def write_latex(self, f: TextIO, headings: list[str] | None = None, sharded: bool = False, keep: bool = True):
+        # Written out as each heading is rendered, the document never exists as one string. With keep=False
+        # the DictEntry objects don't pile up either.
+        stream = env.get_template("dict.latex").stream({"entries":self.iter_context(headings, keep), "sharded":sharded})
+        stream.enable_buffering(64)
+        stream.dump(f)
+
+    def html_pages(self, page_size: int = 0) -> list[list[str]]:
+        # The sorted headings in pages of `page_size` (0 for one page), and always at least one page.
+        headings = self.sorted_headings()
+        page_size = page_size or len(headings) or 1
+        return [headings[i:i + page_size] for i in range(0, len(headings), page_size)] or [[]]
+
+    def write_html(self, f: TextIO, pages: list[list[str]], page: int = 1, title: str = "", page_url: str = "?page={}"):
+        # Page `page` (from 1) of html_pages(), streamed the same way as the LaTeX, with links to every
+        # page. `page_url` is where each page is, with {} for its number.
+        stream = html_env.get_template("dict.html").stream({
+            "title": title,
+            "pages": [(page_url.format(number), headings[0] if headings else "", headings[-1] if headings else "") for number, headings in enumerate(pages, 1)],
+            "page": page,
+            "entries": (preview_entry(dictentry) for dictentry in self.iter_plain(pages[page - 1])),
+        })
+        stream.enable_buffering(64)
+        # Jinja writes text to files opened without an encoding, its stubs only allow binary ones.
+        stream.dump(f) # type: ignore
+
+    def write_json(self, f: TextIO):
+        # A JSON array with one object per heading, written as each is put together.
+        f.write("[")
+        for i, dictentry in enumerate(self.iter_plain(self.sorted_headings())):
+            f.write(",\n" if i else "\n")
+            f.write(json.dumps(preview_entry(dictentry), ensure_ascii=False))
+        f.write("\n]\n")
+
+    def sorted_headings(self) -> list[str]:
+        return sorted((key for key in self.entries if key), key=natural_key)
+
+    def iter_context(self, headings: list[str] | None = None, keep: bool = True) -> Iterator[DictEntry]:
+        for entry_key in self.sorted_headings() if headings is None else headings:
+            dictentry = self.dictentries.get(entry_key)
+            if dictentry is None:
+                dictentry = DictEntry(entry_key, self.picked_keys[entry_key], self.entries[entry_key])
+                if keep:
+                    self.dictentries[entry_key] = dictentry
+            yield dictentry
+
+    def iter_plain(self, headings: list[str]) -> Iterator[DictEntry]:
+        # Headings with their senses as plain text. Never kept: the DictEntry objects kept are the LaTeX ones.
+        for entry_key in headings:
+            yield DictEntry(entry_key, self.picked_keys[entry_key], self.entries[entry_key], plain_defn)
+
     def context(self):
-        entries = [DictEntry(entry_key, pick_sense(self.parsed_keys[entry_key], entry_key, None), entry_body) for entry_key, entry_body in self.entries.items() if entry_key]        
-        return sort_top_dictentries(entries)
-
-def make_dictionary (f : list[list[tuple[str, str]]]) -> Dictionary :
-    d = Dictionary(f)
-    inflected_senses = list({sense for entry in d.crkentries for sense in entry.subsenses_expanded if sense.strip()})
-    parsed_senses = tag_sentences(inflected_senses)
-    transfered_senses = {inflected:parsed_senses[key] for key, inflected in enumerate(inflected_senses)}
-    # Now that we have the data, we can actually provide the correct definitions to each sense
-    for entry in d.crkentries:
-        entry.parsed_subsenses = [transfered_senses[sense] for sense in entry.subsenses_expanded if sense.strip()]
-        entry.processed_subsenses = [pick_sense(parsed, entry.subsenses[i], entry) for i, parsed in enumerate(entry.parsed_subsenses)]   
-    return d
+        return list(self.iter_context())
+
+    def shard_headings(self, shards: int) -> list[list[str]]:
+        # Cut only between letters, so every shard is a run of whole letters of about the same size.
+        sections: list[tuple[str, list[str], int]] = []
+        for heading in self.sorted_headings():
+            letter = heading[:1].lower()
+            if not sections or sections[-1][0] != letter:
+                sections.append((letter, [], 0))
+            sections[-1][1].append(heading)
+        sections = [(letter, section, sum(self.entries[heading].weight() for heading in section)) for letter, section, _ in sections]
+        total = sum(weight for _, _, weight in sections)
+        parts: list[list[str]] = [[]]
+        done = 0
+        for _, section, weight in sections:
+            # A new shard starts when the middle of this letter is past the end of the current one.
+            if parts[-1] and len(parts) < shards and done + weight / 2 > total * len(parts) / shards:
+                parts.append([])
+            parts[-1].extend(section)
+            done += weight
+        return parts
+
+def stitch_latex(pdf_files: list[str]) -> str:
+    return env.get_template("stitch.latex").render({"pdf_files":pdf_files})
+
+def make_dictionary (f : list[list[tuple[str, str]]], tagger: Tagger | None = None, workers: int | None = None, previous: Dictionary | None = None, on_stage: Callable[[str], None] | None = None) -> Dictionary :
+    return Dictionary(f, tagger, workers, previous, on_stage)
 
 def pick_sense(parsed: list[tuple[str,str,str]], original:str, entry: TBEntry | None)-> str:
     # The entry is there in case we need to so some distinction for vai/vti/etc.
@@ -246,4 +626,4 @@ def pick_sense(parsed: list[tuple[str,str,str]], original:str, entry: TBEntry |
     return ' '.join([x[2] if x[1].startswith("V") else x[0] for x in candidate])
 
 def sort_top_dictentries(entries: list[DictEntry])-> list[DictEntry]:
-    return natsort.natsorted(entries, key = attrgetter("head"), alg=ns.NUMAFTER | ns.GROUPLETTERS | ns.LOWERCASEFIRST)
+    return sorted(entries, key = lambda x: natural_key(x.head))
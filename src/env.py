@@ -2,4 +2,62 @@ import os
 import sys
 from pathlib import Path
 
-TOOLBOX_FILE = os.fspath(Path(sys.path[0]) / ".." /"data"/ "Wolvengrey_altlab.toolbox")
\ No newline at end of file
+TOOLBOX_FILE = os.fspath(Path(sys.path[0]) / ".." /"data"/ "Wolvengrey_altlab.toolbox")
+
+# Which taggers.py backend builds use unless they ask for another one.
+TAGGER = os.environ.get("TAGGER", "corenlp")
+
+# Processes used to build entries (1 builds them in the calling process, which is faster unless entries are
+# much more expensive than pickling them back and forth), and the smallest batch of entries worth sending to one.
+WORKERS = int(os.environ.get("WORKERS", "1"))
+MIN_CHUNK_SIZE = int(os.environ.get("MIN_CHUNK_SIZE", "2000"))
+
+# Builds the server runs at once, how many more may wait, and where their scratch directories go (None for the system default).
+BUILD_WORKERS = int(os.environ.get("BUILD_WORKERS", "2"))
+BUILD_QUEUE_DEPTH = int(os.environ.get("BUILD_QUEUE_DEPTH", "4"))
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR") or None
+
+# How many documents the LaTeX is split into, by letter, to run pdflatex on them in parallel (1 for a single document).
+LATEX_SHARDS = int(os.environ.get("LATEX_SHARDS", "1"))
+
+# Where cProfile stats of every build go (None to not profile), and whether to trace memory per stage.
+PROFILE_DIR = os.environ.get("PROFILE_DIR") or None
+TRACE_MEMORY = os.environ.get("TRACE_MEMORY", "") not in ("", "0")
+
+# How many previous builds the server keeps to rebuild incrementally from (0 for none: with no snapshots either, builds then render in flat memory).
+INCREMENTAL_BUILDS = int(os.environ.get("INCREMENTAL_BUILDS", "4"))
+
+# How many natsort keys are kept around between sorts.
+SORT_KEY_CACHE_SIZE = int(os.environ.get("SORT_KEY_CACHE_SIZE", str(1 << 18)))
+
+# How many LaTeX-escaped sense fragments are kept around between builds.
+ESCAPE_CACHE_SIZE = int(os.environ.get("ESCAPE_CACHE_SIZE", str(1 << 18)))
+
+# How many CoreNLP JVMs the server keeps running, and how often they get checked.
+CORENLP_INSTANCES = int(os.environ.get("CORENLP_INSTANCES", "1"))
+CORENLP_HEALTH_INTERVAL = float(os.environ.get("CORENLP_HEALTH_INTERVAL", "30"))
+CORENLP_HEALTH_TIMEOUT = float(os.environ.get("CORENLP_HEALTH_TIMEOUT", "5"))
+
+# Sentences per CoreNLP request, how many requests are in flight at once, and what to do when one stalls.
+TAG_BATCH_SIZE = int(os.environ.get("TAG_BATCH_SIZE", "500"))
+TAG_CONCURRENCY = int(os.environ.get("TAG_CONCURRENCY", str(os.cpu_count() or 1)))
+TAG_TIMEOUT = float(os.environ.get("TAG_TIMEOUT", "120"))
+TAG_RETRIES = int(os.environ.get("TAG_RETRIES", "2"))
+
+# Headings per page of the HTML preview.
+PREVIEW_PAGE_SIZE = int(os.environ.get("PREVIEW_PAGE_SIZE", "250"))
+
+# Where persistent caches live, relative to the working directory unless absolute.
+CACHE_DIR = os.environ.get("CACHE_DIR", "cache")
+TAG_CACHE_FILE = os.path.join(CACHE_DIR, "tags.sqlite3")
+TAG_CACHE_MAX_BYTES = int(os.environ.get("TAG_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+ARTIFACT_DIR = os.environ.get("ARTIFACT_DIR", os.path.join(CACHE_DIR, "artifacts"))
+ARTIFACT_MAX_BYTES = int(os.environ.get("ARTIFACT_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Where built dictionaries are saved to reload without parsing and tagging, and how many upload files keep one.
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(CACHE_DIR, "snapshots"))
+SNAPSHOT_KEEP = int(os.environ.get("SNAPSHOT_KEEP", "16"))
+
+# Where finished build jobs keep their PDFs, and for how many seconds after they finish.
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(CACHE_DIR, "jobs"))
+JOB_TTL = float(os.environ.get("JOB_TTL", "3600"))
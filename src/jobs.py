@@ -0,0 +1,139 @@
+"""
+jobs.py: Builds the server runs in the background, their progress, and the PDFs they leave behind for a while.
+"""
+import os
+import secrets
+import threading
+import time
+from metrics import BuildMetrics
+
+# What a job can produce, and the content type it is served with.
+FORMATS = {
+    "pdf": "application/pdf",
+    "html": "text/html; charset=utf-8",
+    "json": "application/json; charset=utf-8",
+}
+
+def page_path(output_file: str, page: int) -> str:
+    # Where page `page` of a paginated output goes: the first is the output file itself, the others are beside it.
+    if page == 1:
+        return output_file
+    root, ext = os.path.splitext(output_file)
+    return f"{root}.{page}{ext}"
+
+class Job:
+    """
+    One upload being built. The build calls enter() as it moves from stage to stage, and its
+    metrics keep the time spent in each by name, so going back to a stage (the entries are
+    parsed both while the upload is read and once the build starts) adds to it.
+    """
+
+    def __init__(self):
+        self.id = secrets.token_urlsafe(12)
+        self.name: str | None = None
+        self.format = "pdf"
+        self.created = time.monotonic()
+        self.state = "queued"
+        self.stage: str | None = None
+        self.metrics = BuildMetrics()
+        self.error: Exception | None = None
+        self.output_file: str | None = None
+        self.finished: float | None = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def enter(self, stage: str):
+        with self.lock:
+            self.metrics.enter(stage)
+            self.state = "running"
+            self.stage = stage
+
+    def queue(self):
+        with self.lock:
+            self.metrics.close()
+            self.state = "queued"
+            self.stage = None
+
+    def finish(self, output_file: str | None = None, error: Exception | None = None):
+        with self.lock:
+            self.metrics.close()
+            self.stage = None
+            self.output_file = output_file
+            self.error = error
+            self.state = "failed" if error is not None else "done"
+            self.finished = time.monotonic()
+        self.done.set()
+
+    def status(self, ttl: float) -> dict:
+        with self.lock:
+            now = time.monotonic()
+            stages = self.metrics.snapshot()
+            return {
+                "id": self.id,
+                "file": self.name,
+                "format": self.format,
+                "state": self.state,
+                "stage": self.stage,
+                "stages": [{"stage": stage, "seconds": record["wall"]} for stage, record in stages.items()],
+                "elapsed": round((self.finished or now) - self.created, 3),
+                "expires_in": round(self.finished + ttl - now, 3) if self.finished is not None else None,
+                "metrics": stages,
+            }
+
+class JobStore:
+    """The jobs the server knows about. Finished ones, and what they produced, are dropped `ttl` seconds after they finish."""
+
+    def __init__(self, directory: str, ttl: float):
+        self.directory = directory
+        self.ttl = ttl
+        self.jobs: dict[str, Job] = dict()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Jobs don't outlive the server, so neither does what they produced.
+        for leftover in os.listdir(directory):
+            if leftover.endswith(tuple(f".{format}" for format in FORMATS)):
+                os.remove(os.path.join(directory, leftover))
+
+    def create(self) -> Job:
+        self.evict()
+        job = Job()
+        with self.lock:
+            self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        self.evict()
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def output_file(self, job: Job) -> str:
+        return os.path.join(self.directory, f"{job.id}.{job.format}")
+
+    def page_file(self, job: Job, page: int) -> str | None:
+        # Page `page` of what a job produced, if it has that many: only HTML previews have more than the first.
+        if job.output_file is None:
+            return None
+        page_file = page_path(job.output_file, page)
+        return page_file if os.path.exists(page_file) else None
+
+    def save_pdf(self, job: Job, pdf: bytes) -> str:
+        pdf_file = self.output_file(job)
+        with open(pdf_file, "wb") as f:
+            f.write(pdf)
+        return pdf_file
+
+    def discard(self, job: Job):
+        with self.lock:
+            self.jobs.pop(job.id, None)
+        if job.output_file is not None:
+            page = 1
+            while (page_file := self.page_file(job, page)) is not None:
+                os.remove(page_file)
+                page += 1
+
+    def evict(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [job for job in self.jobs.values() if job.finished is not None and job.finished + self.ttl < now]
+        for job in expired:
+            self.discard(job)
@@ -0,0 +1,100 @@
+"""
+merge.py: Replaces some fields of a toolbox file with those of a CSV export, matching entries on their \\sro, \\ps and \\def.
+"""
+import csv
+from typing import Iterable, TextIO
+from parse import iter_lines, iter_toolbox_sources, read_header
+
+KEY_FIELDS = ("\\sro", "\\ps", "\\def")
+# How a field that appears more than once in an entry is joined in the key, and how a CSV cell holds several values.
+KEY_SEPARATOR = " ;; "
+VALUE_SEPARATOR = ";;"
+
+Key = tuple[str, ...]
+
+class CsvIndex:
+    """
+    The CSV rows by key, keeping only the fields to merge, so the index stays small however wide
+    the export is. Rows with an empty key are skipped. When the same key comes up again, the first
+    row wins; if the later one would merge something else, the key is `ambiguous`, unless it is one
+    of the `duplicates` known to be the same entry twice.
+    """
+
+    def __init__(self, rows: Iterable[dict[str, str]], fields: list[str], key_fields: tuple[str, ...] = KEY_FIELDS, duplicates: Iterable[Key] = ()):
+        self.fields = fields
+        self.key_fields = key_fields
+        self.rows: dict[Key, tuple[str, ...]] = dict()
+        self.ambiguous: list[Key] = []
+        duplicates = set(duplicates)
+        for row in rows:
+            key = tuple(row.get(field) or "" for field in key_fields)
+            if not any(key):
+                continue
+            values = tuple(row.get(field) or "" for field in fields)
+            if self.rows.setdefault(key, values) != values and key not in duplicates:
+                self.ambiguous.append(key)
+
+    @classmethod
+    def from_csv(cls, f: TextIO, fields: list[str], key_fields: tuple[str, ...] = KEY_FIELDS, duplicates: Iterable[Key] = ()) -> "CsvIndex":
+        return cls(csv.DictReader(f), fields, key_fields, duplicates)
+
+class MergeReport:
+    """What a merge matched, and what it couldn't."""
+
+    def __init__(self):
+        self.entries = 0
+        self.merged = 0
+        # Toolbox entries with no CSV row, and those among them whose \\sro does have one (most likely a typo on either side).
+        self.missing = 0
+        self.near_misses: list[Key] = []
+        # CSV rows no entry matched, but for those known not to.
+        self.unmatched: list[Key] = []
+
+    def summary(self) -> str:
+        return f"{self.merged} of {self.entries} entries merged, {self.missing} without a CSV row ({len(self.near_misses)} of them near misses), {len(self.unmatched)} CSV rows unmatched."
+
+def entry_key(entry: list[tuple[str, str]], key_fields: tuple[str, ...] = KEY_FIELDS) -> Key:
+    return tuple(KEY_SEPARATOR.join(value for field, value in entry if field == key_field) for key_field in key_fields)
+
+def merged_lines(fields: list[str], values: tuple[str, ...] | None) -> list[str]:
+    # A field with no value is still written, empty, so every entry ends up with all of them.
+    lines: list[str] = []
+    for field, value in zip(fields, values or ("",) * len(fields)):
+        if value:
+            lines.extend(f"{field} {part.strip()}" for part in value.split(VALUE_SEPARATOR))
+        else:
+            lines.append(field)
+    return lines
+
+def merge_toolbox(toolbox, index: CsvIndex, output: TextIO, expected_unmatched: Iterable[Key] = ()) -> MergeReport:
+    """
+    Writes the toolbox file (anything parse.iter_lines reads) to `output` an entry at a time, with
+    the fields of the index replaced by the CSV's. They go just before the last line of each entry
+    (its \\dt), and are left empty in entries the CSV has no row for.
+    """
+    report = MergeReport()
+    f = iter_lines(toolbox)
+    output.write(f"{read_header(f)}\n\n")
+    replaced = set(index.fields)
+    matched: set[Key] = set()
+    heads = {key[0] for key in index.rows}
+    for entry, source in iter_toolbox_sources(f):
+        if not source:
+            continue
+        report.entries += 1
+        key = entry_key(entry, index.key_fields)
+        values = index.rows.get(key)
+        if values is None:
+            report.missing += 1
+            if key[0] in heads:
+                report.near_misses.append(key)
+        else:
+            report.merged += 1
+            matched.add(key)
+        kept = [line for line in source if line.strip().partition(" ")[0] not in replaced]
+        lines = kept[:-1] + merged_lines(index.fields, values) + kept[-1:]
+        output.write("\n".join(lines))
+        output.write("\n\n")
+    expected = set(expected_unmatched)
+    report.unmatched = [key for key in index.rows if key not in matched and key not in expected]
+    return report
@@ -0,0 +1,119 @@
+"""
+metrics.py: Where each build spends its time and memory, and the running totals the server reports at /metrics.
+"""
+import json
+import resource
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+class BuildMetrics:
+    """
+    Wall time, CPU time, peak memory and item counts for each stage of one build, kept by stage
+    name so that going back to a stage adds to it. CPU time is that of the thread running the
+    stage: work it hands to other threads, processes or CoreNLP isn't in it. Peak Python memory
+    is only measured while tracemalloc is tracing (the server's --trace-memory). The process
+    high-water mark never goes down, so it says nothing of a stage: see process_peak_rss_kib().
+    """
+
+    def __init__(self):
+        self.stages: dict[str, dict] = dict()
+        self.stage: str | None = None
+        self.started = (0.0, 0.0)
+        self.lock = threading.Lock()
+
+    def record(self, stage: str) -> dict:
+        return self.stages.setdefault(stage, {"wall": 0.0, "cpu": 0.0, "counts": dict()})
+
+    def close(self):
+        with self.lock:
+            self.close_stage()
+
+    def close_stage(self):
+        if self.stage is None:
+            return
+        record = self.record(self.stage)
+        wall, cpu = self.started
+        record["wall"] += time.monotonic() - wall
+        record["cpu"] += time.thread_time() - cpu
+        if tracemalloc.is_tracing():
+            record["peak_traced_kib"] = max(record.get("peak_traced_kib", 0), tracemalloc.get_traced_memory()[1] // 1024)
+        self.stage = None
+
+    def enter(self, stage: str):
+        with self.lock:
+            if stage == self.stage:
+                return
+            self.close_stage()
+            self.stage = stage
+            self.started = (time.monotonic(), time.thread_time())
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+
+    def count(self, stage: str, **counts: int):
+        with self.lock:
+            record = self.record(stage)["counts"]
+            for name, value in counts.items():
+                record[name] = record.get(name, 0) + value
+
+    def snapshot(self) -> dict[str, dict]:
+        # The stage still running is reported with its wall time so far.
+        with self.lock:
+            stages = {stage: dict(record, counts=dict(record["counts"])) for stage, record in self.stages.items()}
+            if self.stage is not None:
+                record = stages.setdefault(self.stage, {"wall": 0.0, "cpu": 0.0, "counts": dict()})
+                record["wall"] = record["wall"] + time.monotonic() - self.started[0]
+        for record in stages.values():
+            record["wall"] = round(record["wall"], 3)
+            record["cpu"] = round(record["cpu"], 3)
+        return stages
+
+class MetricsRegistry:
+    """Totals over every build the server has run, and the last few build records."""
+
+    def __init__(self, history: int = 50):
+        self.counters: dict[str, int] = dict()
+        self.stages: dict[str, dict] = dict()
+        self.recent: deque[dict] = deque(maxlen=history)
+        self.lock = threading.Lock()
+
+    def increment(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_build(self, record: dict):
+        with self.lock:
+            self.counters["builds"] = self.counters.get("builds", 0) + 1
+            outcome = f"builds_{record['outcome']}"
+            self.counters[outcome] = self.counters.get(outcome, 0) + 1
+            for stage, numbers in record["stages"].items():
+                total = self.stages.setdefault(stage, {"builds": 0, "wall": 0.0, "cpu": 0.0, "max_wall": 0.0, "counts": dict()})
+                total["builds"] += 1
+                total["wall"] = round(total["wall"] + numbers["wall"], 3)
+                total["cpu"] = round(total["cpu"] + numbers["cpu"], 3)
+                total["max_wall"] = max(total["max_wall"], numbers["wall"])
+                if "peak_traced_kib" in numbers:
+                    total["max_peak_traced_kib"] = max(total.get("max_peak_traced_kib", 0), numbers["peak_traced_kib"])
+                for name, value in numbers["counts"].items():
+                    total["counts"][name] = total["counts"].get(name, 0) + value
+            self.recent.append(record)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "stages": {stage: dict(total, counts=dict(total["counts"])) for stage, total in self.stages.items()},
+                "recent": list(self.recent),
+            }
+
+registry = MetricsRegistry()
+
+def process_peak_rss_kib() -> int:
+    # The most memory the whole process has held since it started, every build and thread included.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def log_build(record: dict):
+    # One JSON object per line, so the logs can be grepped and parsed as they are.
+    registry.add_build(record)
+    print(json.dumps(record), flush=True)
@@ -1,44 +1,98 @@
-from typing import Iterator
+import codecs
+import io
+from functools import partial
+from typing import Iterable, Iterator
 
+READ_SIZE = 64 * 1024
 
 def so_far_collected(data) -> str:
     return '\n'.join([" ".join(x) for x in data])
 
-def build_toolbox_data_structure( iterator : Iterator[str] ) -> list[list[tuple[str, str]]]:
-    entries = []
+def decode_lines(chunks: Iterable[bytes | bytearray], encoding: str = "utf-8") -> Iterator[str]:
+    # Decodes as the bytes come in, and splits lines the same way str.splitlines does.
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ""
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.splitlines(True)
+        # The last line may continue in the next chunk (or be a "\r" waiting for its "\n").
+        pending = lines.pop() if lines else ""
+        for line in lines:
+            yield line.splitlines()[0]
+    pending += decoder.decode(b"", final=True)
+    yield from pending.splitlines()
+
+def iter_lines(source) -> Iterator[str]:
+    """Lines without their endings, from a string, bytes, a binary or text file, or any iterable of lines."""
+    if isinstance(source, str):
+        yield from source.splitlines()
+    elif isinstance(source, (bytes, bytearray)):
+        yield from decode_lines([source])
+    elif hasattr(source, "read") and not isinstance(source, io.TextIOBase):
+        yield from decode_lines(iter(partial(source.read, READ_SIZE), b""))
+    else:
+        for line in source:
+            yield line.rstrip("\r\n")
+
+def check_line( candidate : tuple[str, str, str], line : str, linenum : int, entry : list[tuple[str, str]] ) -> ValueError | None:
+    # What is wrong with a line that isn't blank (and `candidate`, the line partitioned), if anything. `entry` is what was read of its entry so far.
+    if len(candidate) != 3:
+        err = ValueError(f"Line {linenum} does not have a mapping.  This mean a line does not have a space after the toolbox key.  You might want to ask altlab for help with this.")
+    elif not candidate[0].startswith("\\"):
+        err = ValueError(f"Line {linenum} missing toolbox key.  This likely means an incorrect line break was added in the previous line.")
+    else:
+        return None
+    err.debug_info = so_far_collected(entry)
+    err.last_line = line
+    return err
+
+def iter_toolbox_data_structure( iterator : Iterator[str] ) -> Iterator[list[tuple[str, str]]]:
     entry = []
     linenum = 3
     for line in iterator:
         if not line.strip():
-            entries.append(entry)
+            yield entry
             entry = [("line", str(linenum))]
         else:
             candidate = line.strip().partition(" ")
-            if len(candidate) != 3:
-                err = ValueError(f"Line {linenum} does not have a mapping.  This mean a line does not have a space after the toolbox key.  You might want to ask altlab for help with this.")
-                err.debug_info = so_far_collected(entry)
-                err.last_line = line
-                raise err
-            if not candidate[0].startswith("\\"):
-                err = ValueError(f"Line {linenum} missing toolbox key.  This likely means an incorrect line break was added in the previous line.")
-                err.debug_info = so_far_collected(entry)
-                err.last_line = line
+            err = check_line(candidate, line, linenum, entry)
+            if err is not None:
                 raise err
             entry.append((candidate[0], candidate[2]))
         linenum += 1
     # Now add last entry
     if len(entry) > 1:
-        entries.append(entry)
+        yield entry
 
+def build_toolbox_data_structure( iterator : Iterator[str] ) -> list[list[tuple[str, str]]]:
     # Finished first attempt at parsing.
-    return entries
+    return list(iter_toolbox_data_structure(iterator))
 
-def load_toolbox( data : str) -> list[list[tuple[str, str]]]:
-    f = iter(data.splitlines())
-    header = next(f)
+def iter_toolbox_sources( iterator : Iterator[str] ) -> Iterator[tuple[list[tuple[str, str]], list[str]]]:
+    # Each entry with the lines it was parsed from, as they were, for tools that rewrite the file.
+    lines = []
+    def recorded():
+        for line in iterator:
+            lines.append(line)
+            yield line
+    for entry in iter_toolbox_data_structure(recorded()):
+        # An entry is yielded once the blank line after it is read, or at the end of the file.
+        yield entry, [line for line in lines if line.strip()]
+        lines.clear()
+
+def read_header( f : Iterator[str] ) -> str:
+    header = next(f, "")
     if not header.startswith("\\_sh "):
         raise ValueError(f"first line is not as expected: {header}. Ask altlab about this.")
-    if next(f).strip():
+    if next(f, "").strip():
         raise ValueError(f"More than one line in the toolbox file header. Ask altlab about this.")
-    return build_toolbox_data_structure (f)
+    return header
+
+def iter_toolbox( data ) -> Iterator[list[tuple[str, str]]]:
+    # Yields entries as their lines are read, so a bad line is reported before the rest is even read.
+    f = iter_lines(data)
+    read_header(f)
+    yield from iter_toolbox_data_structure (f)
 
+def load_toolbox( data ) -> list[list[tuple[str, str]]]:
+    return list(iter_toolbox(data))
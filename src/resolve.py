@@ -0,0 +1,121 @@
+"""
+resolve.py: Resolves git merge conflicts in toolbox files as they are read, with rules about which side of each field to keep.
+"""
+import re
+from typing import Iterable, TextIO
+
+Line = tuple[str | None, str]
+
+class Rule:
+    """
+    One way of resolving a conflict. resolve() gets both sides as (field, line) pairs, the field
+    being one of those some rule asked for (or None), and returns the lines to write instead of
+    the conflict, or None when the rule doesn't apply to it.
+    """
+    name = "rule"
+    fields: set[str] = set()
+
+    def resolve(self, left: list[Line], right: list[Line]) -> list[str] | None:
+        raise NotImplementedError
+
+class DateOnlyEnding(Rule):
+    """
+    The left side only adds or changes `moved` fields at the end of an entry, and otherwise
+    only has its date: keep the left side's `moved` fields and everything else of the right's.
+    """
+    name = "date-only ending"
+
+    def __init__(self, moved: set[str], date: str = "\\dt"):
+        self.moved = moved
+        self.date = date
+        self.fields = moved | {date}
+
+    def resolve(self, left: list[Line], right: list[Line]) -> list[str] | None:
+        if any(field != self.date for field, _ in left if field not in self.moved):
+            return None
+        if not right:
+            return [line for _, line in left]
+        return [line for field, line in left if field in self.moved] + [line for field, line in right if field not in self.moved]
+
+class KeepFields(Rule):
+    """Both sides are the same but for `fields`: keep those of `side`."""
+
+    def __init__(self, fields: set[str], side: str):
+        self.fields = fields
+        self.side = side
+        self.name = f"keep {side} {' '.join(sorted(fields))}"
+
+    def resolve(self, left: list[Line], right: list[Line]) -> list[str] | None:
+        if [line for field, line in left if field not in self.fields] != [line for field, line in right if field not in self.fields]:
+            return None
+        return [line for _, line in (left if self.side == "left" else right)]
+
+def field_matcher(fields: Iterable[str]) -> re.Pattern:
+    # One pattern for the fields of every rule, so each line of a conflict is looked at once. Longest
+    # first, although a field only matches when followed by a space or the end of the line anyway.
+    alternatives = "|".join(re.escape(field) for field in sorted(fields, key=len, reverse=True))
+    return re.compile(f"({alternatives})(?= |\\r?\\n|$)" if alternatives else "(?!)")
+
+class Resolver:
+    """
+    Copies a conflicted file, writing the text outside conflicts straight through and each conflict,
+    once read, as the first rule that applies resolves it. Conflicts no rule applies to are written
+    back as they were. `stats` counts the conflicts each rule resolved, and those none did.
+    """
+
+    def __init__(self, rules: list[Rule]):
+        self.rules = rules
+        self.matcher = field_matcher({field for rule in rules for field in rule.fields})
+        self.stats = {rule.name: 0 for rule in rules}
+        self.stats["unresolved"] = 0
+        self.conflicts = 0
+
+    def classify(self, lines: list[str]) -> list[Line]:
+        match = self.matcher.match
+        return [(m.group(1) if (m := match(line)) else None, line) for line in lines]
+
+    def resolve_conflict(self, markers: list[str], left: list[str], base: list[str], right: list[str]) -> list[str]:
+        self.conflicts += 1
+        classified_left, classified_right = self.classify(left), self.classify(right)
+        for rule in self.rules:
+            resolved = rule.resolve(classified_left, classified_right)
+            if resolved is not None:
+                self.stats[rule.name] += 1
+                return resolved
+        self.stats["unresolved"] += 1
+        start, separator, end = markers
+        return [start, *left, *base, separator, *right, end]
+
+    def resolve(self, lines: Iterable[str], output: TextIO):
+        # Lines keep their line endings, so whatever isn't resolved comes out byte for byte.
+        section: list[str] | None = None
+        markers: list[str] = []
+        left: list[str] = []
+        base: list[str] = []
+        right: list[str] = []
+        for linenum, line in enumerate(lines, 1):
+            if section is None:
+                if line.startswith("<<<<<<<"):
+                    start = linenum
+                    markers, left, base, right = [line], [], [], []
+                    section = left
+                else:
+                    output.write(line)
+            elif line.startswith("|||||||") and section is left:
+                # The common ancestor, in diff3 conflicts, kept with its marker only to be written back.
+                base.append(line)
+                section = base
+            elif line.startswith("=======") and section is not right:
+                markers.append(line)
+                section = right
+            elif line.startswith(">>>>>>>") and section is right:
+                markers.append(line)
+                output.writelines(self.resolve_conflict(markers, left, base, right))
+                section = None
+            else:
+                section.append(line)
+        if section is not None:
+            raise ValueError(f"The conflict that starts on line {start} never ends.")
+
+    def summary(self) -> str:
+        return "\n".join([f"Conflicts: {self.conflicts}"] + [f"{name}: {count}" for name, count in self.stats.items()])
@@ -1,90 +1,313 @@
+import argparse
+import hashlib
 import http.server
-import socketserver
-import io
-from multipart import parse_options_header, MultipartParser
+import json
+import os
+import shutil
+import time
+import tracemalloc
+from itertools import chain, takewhile
+from typing import Callable, Iterator, TypeVar
+from urllib.parse import parse_qs, urlsplit
+from multipart import parse_options_header, MultipartError, PushMultipartParser, MultipartSegment
 from latex import LatexBuildError
-from latex.build import PdfLatexBuilder
-from parse import load_toolbox
-from entries import make_dictionary
+from parse import load_toolbox, decode_lines, READ_SIZE
+from entries import validate_toolbox
+from build import BuildPool, run_job, describe_error, finish_from_cache, get_artifacts, report, upload_key
+from jobs import FORMATS, Job, JobStore
+from metrics import process_peak_rss_kib, registry
+from stanford import start_service, stop_service, cache_stats
+from taggers import get_tagger, TAGGERS
+import env
+
+# Whatever read_form's reader makes of the toolbox file.
+T = TypeVar("T")
+
+def multipart_events(stream, boundary: str, length: int):
+    # Feeds the request body to the parser as it is read, never holding more than READ_SIZE of it.
+    remaining = length
+    with PushMultipartParser(boundary, length) as parser:
+        while not parser.closed:
+            chunk = stream.read(min(READ_SIZE, remaining))
+            remaining -= len(chunk)
+            yield from parser.parse(chunk)
+
+def hashing(chunks, digest):
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
 
 class ArokHandler(http.server.BaseHTTPRequestHandler):
+    default_tagger = env.TAGGER
+    workers = env.WORKERS
+    latex_shards = env.LATEX_SHARDS
+    profile_dir = env.PROFILE_DIR
+    build_pool: BuildPool
+    jobs: JobStore
+
     def do_GET(self):
+        # /jobs/<id> is the status of a job, /jobs/<id>/pdf its PDF (or /html, /json its preview), /metrics the build totals. Everything else gets the form.
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts == ["metrics"]:
+            self.send_json(self.metrics())
+            return
+        if parts[0] == "jobs" and len(parts) in (2, 3):
+            job = self.jobs.get(parts[1])
+            if job is None:
+                self.send_text("There is no such job. Finished jobs are only kept for a while.", 404)
+            elif len(parts) == 2:
+                self.send_json(self.job_status(job))
+            elif parts[2] == job.format and job.done.is_set():
+                page = parse_qs(urlsplit(self.path).query).get("page", ["1"])[0]
+                self.send_job_result(job, int(page) if page.isdigit() else 0)
+            else:
+                self.send_json(self.job_status(job), 409 if parts[2] == job.format else 404)
+            return
         self.send_response(200)
         self.send_header("Content-Type", "text/html; charset=utf-8")
         self.end_headers()
         with open("index.html", "rb") as f:
             self.wfile.write(f.read())
 
-    def do_POST(self):
-        print("post requested.")
-        length = int(self.headers.get('content-length', "0"))
-        data = self.rfile.read(length)
-        content_type, options = parse_options_header(self.headers.get('content-type'))
+    def read_form(self, boundary: str, length: int, read_toolbox: Callable[[Iterator[str]], T]) -> tuple[T | None, str | None, dict[str, str]]:
+        # The toolbox file is read (by `read_toolbox`, whatever it makes of the lines) straight off the socket
+        # as it arrives, so a formatting error stops the upload at the bad line. Returns what read_toolbox
+        # returned, the file name and the other fields, which are small and kept as text, with the sha256 of the file.
         toolbox = None
-        if content_type == "multipart/form-data" and 'boundary' in options:
-            boundary = options["boundary"]
-            parser = MultipartParser(io.BytesIO(data), boundary)
-
-            for part in parser: 
-                if part and part.filename and part.name == 'toolbox':
-                    toolbox = part.value
-            # Free up resources after use
-            for part in parser.parts():
-                if part:
-                    part.close()
-            if toolbox:
-                try:
-                    dict_file = make_dictionary(load_toolbox(toolbox))
-                    print("Dictionary made. building...")
-                except ValueError as e:
-                    self.send_response(200)
-                    self.send_header("Content-Type", "text/plain; charset=utf-8")
-                    self.end_headers()
-                    self.wfile.write("Your toolbox file has some formatting issues.  This is the error we detected:\n\n\n".encode("utf-8"))
-                    self.wfile.write("{}\n\n".format(str(e)).encode())
-                    if "debug_info" in dir(e):                        
-                        self.wfile.write("The problem is in the following entry, which likely has more information, but we had to stop parsing it from the issue we just mentioned.\n\n".encode())
-                        self.wfile.write(e.debug_info.encode())
-                        self.wfile.write("\n{}\n{}\n".format(e.last_line,"^"*len(e.last_line)).encode())
-                    self.wfile.write("\n\n".encode())
-                    #self.wfile.write("{}\n\n".format(str(e)).encode("utf-8"))
-                    return
-                try:
-                    builder = PdfLatexBuilder(pdflatex="pdflatex")
-                    latex = dict_file.latex()
-                    with open ("dict.tex", "w") as f:
-                        f.write(latex)
-                    pdf = builder.build_pdf(latex) 
-                    self.send_response(200)
-                    self.send_header("Content-Type", "application/pdf; charset=utf-8")
-                    self.send_header("Content-Disposition", "inline; filename=\"dictionary.pdf\"")
-                    self.end_headers()
-                    self.wfile.write(bytes(pdf))
-                    return
-                except LatexBuildError as e:
-                    self.send_response(200)
-                    self.send_header("Content-Type", "text/plain")
-                    self.end_headers()
-                    self.wfile.write("There were issues on the file. Send a copy to altlab of the input files.\n\n\n".encode("utf-8"))
-                    for err in e.get_errors():
-                        self.wfile.write("{}\n\t{}\n".format(err["error"],err["context"][1]).encode("utf-8"))
-                    return
-        else:
+        fields: dict[str, str] = dict()
+        filename = None
+        digest = hashlib.sha256()
+        events = multipart_events(self.rfile, boundary, length)
+        for event in events:
+            if isinstance(event, MultipartSegment):
+                body = takewhile(lambda x: x is not None, events)
+                charset = event.charset or "utf-8"
+                if event.name == 'toolbox' and event.filename:
+                    filename = event.filename
+                    first = next(body, None)
+                    if first is not None:
+                        # Hashed on the way through, the artifact cache knows uploads by their bytes.
+                        toolbox = read_toolbox(decode_lines(hashing(chain([first], body), digest), charset))
+                else:
+                    fields[event.name] = b''.join(body).decode(charset)
+        fields["sha256"] = digest.hexdigest()
+        return toolbox, filename, fields
+
+    def send_text(self, text: str, status: int = 200, content_type: str = "text/plain; charset=utf-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.end_headers()
+        self.wfile.write(text.encode("utf-8"))
+
+    def send_json(self, data: dict, status: int = 200):
+        self.send_text(json.dumps(data), status, "application/json")
+
+    def metrics(self) -> dict:
+        metrics = registry.snapshot()
+        metrics["builds_pending"] = self.build_pool.pending
+        metrics["jobs"] = len(self.jobs.jobs)
+        metrics["tag_cache"] = cache_stats()
+        metrics["artifact_cache"] = get_artifacts().stats()
+        metrics["process_peak_rss_kib"] = process_peak_rss_kib()
+        return metrics
+
+    def job_status(self, job: Job) -> dict:
+        status = job.status(self.jobs.ttl)
+        status["error"] = describe_error(job.error) if job.error is not None else None
+        status["result"] = f"/jobs/{job.id}/{job.format}" if job.state == "done" else None
+        status["pdf"] = status["result"] if job.format == "pdf" else None
+        return status
+
+    def send_job_result(self, job: Job, page: int = 1):
+        # Page `page` of an HTML preview; everything else only has the one.
+        output_file = self.jobs.page_file(job, page)
+        if job.error is None and output_file is None:
+            self.send_text("There is no such page.", 404)
+        elif job.error is None and output_file is not None:
             self.send_response(200)
-            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Type", FORMATS[job.format])
+            self.send_header("Content-Disposition", f"inline; filename=\"dictionary.{job.format}\"")
             self.end_headers()
-            self.wfile.write("You didn't send a toolbox file.".encode("utf-8"))
+            with open(output_file, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+        elif isinstance(job.error, LatexBuildError):
+            self.send_text(describe_error(job.error), content_type="text/plain")
+        elif job.error is not None:
+            self.send_text(describe_error(job.error))
+
+    def form_boundary(self) -> str | None:
+        # None, having already answered the request, unless it is a form upload.
+        content_type, options = parse_options_header(self.headers.get('content-type', ""))
+        if content_type != "multipart/form-data" or 'boundary' not in options:
+            self.send_text("You didn't send a toolbox file.")
+            return None
+        return options["boundary"]
+
+    def validate(self):
+        # Every formatting error of the upload at once, without tagging or building anything, and without a job.
+        boundary = self.form_boundary()
+        if boundary is None:
+            return
+        start = time.monotonic()
+        try:
+            result, filename, _ = self.read_form(boundary, int(self.headers.get('content-length', "0")), validate_toolbox)
+        except MultipartError as e:
+            # validate_toolbox reports what is wrong with the file, but only once the form around it can be read.
+            self.send_text(f"The upload could not be read: {e}", 400)
+            return
+        if result is None:
+            self.send_text("You didn't send a toolbox file.")
+            return
+        entries, errors = result
+        registry.increment("validations")
+        self.send_json({
+            "file": filename,
+            "valid": not errors,
+            "entries": entries,
+            "errors": errors,
+            "seconds": round(time.monotonic() - start, 3),
+        })
+
+    def reject_field(self, field: str, value: str, choices) -> bool:
+        # Answers with a 400 when `value` isn't one of `choices`.
+        if value in choices:
+            return False
+        self.send_text(f"Unknown {field} {value}. Pick one of: {', '.join(choices)}.", 400)
+        return True
+
+    def start_job(self) -> Job | None:
+        # Reads and parses the upload, then leaves the rest of the build to the pool. Returns
+        # None when there is nothing to build, having already answered the request.
+        boundary = self.form_boundary()
+        if boundary is None:
+            return None
+        # A PDF unless the form or the query string asks for a preview.
+        query_format = parse_qs(urlsplit(self.path).query).get('format', [None])[0]
+        if query_format is not None and self.reject_field("output format", query_format, FORMATS):
+            return None
+        # Turned away before the upload is read, so a full pool costs neither the time nor the memory of parsing it.
+        if not self.build_pool.reserve():
+            self.send_busy()
+            return None
+        submitted = False
+        try:
+            job = self.jobs.create()
+            job.enter("parsing")
+            try:
+                toolbox, filename, fields = self.read_form(boundary, int(self.headers.get('content-length', "0")), load_toolbox)
+            except ValueError as e:
+                job.finish(error=e)
+                report(job, "failed")
+                return job
+            # The form's own fields only come with the upload. A bad one is the request's fault, not the toolbox
+            # file's: the job made for parsing goes without being finished or reported, and the request gets a 400.
+            tagger_name = fields.get('tagger') or self.default_tagger
+            output = fields.get('format') or query_format or "pdf"
+            if self.reject_field("tagger", tagger_name, TAGGERS) or self.reject_field("output format", output, FORMATS):
+                self.jobs.discard(job)
+                return None
+            if not toolbox:
+                self.jobs.discard(job)
+                self.send_text("You didn't send a toolbox file.")
+                return None
+            tagger = get_tagger(tagger_name)
+            job.format = output
+            job.name = filename
+            key = upload_key(fields["sha256"], tagger, self.latex_shards)
+            if job.format == "pdf" and finish_from_cache(job, self.jobs, key):
+                return job
+            job.queue()
+            self.build_pool.submit(run_job, job, self.jobs, toolbox, tagger, self.workers, key, self.latex_shards, self.profile_dir, fields["sha256"])
+            submitted = True
+            return job
+        finally:
+            if not submitted:
+                self.build_pool.cancel()
+
+    def send_busy(self):
+        self.send_response(503)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Retry-After", "60")
+        self.end_headers()
+        self.wfile.write("The server is busy building other dictionaries. Please try again in a few minutes.".encode("utf-8"))
+
+    def do_POST(self):
+        print("post requested.")
+        if self.path.split("?")[0].rstrip("/") == "/validate":
+            self.validate()
+            return
+        if self.path.split("?")[0].rstrip("/") == "/jobs":
+            # Answers as soon as the upload is parsed; the build goes on in the background.
+            job = self.start_job()
+            if job is not None:
+                self.send_response(202)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Location", f"/jobs/{job.id}")
+                self.end_headers()
+                self.wfile.write(json.dumps(self.job_status(job)).encode("utf-8"))
+            return
+        # The single-shot upload is a job whose result is sent back as soon as it is done.
+        job = self.start_job()
+        if job is None:
+            return
+        job.done.wait()
+        try:
+            if job.error is not None and not isinstance(job.error, (ValueError, LatexBuildError)):
+                raise job.error
+            self.send_job_result(job)
+        finally:
+            # The other pages of an HTML preview are fetched from the job afterwards, it expires like any other.
+            if job.format != "html" or job.error is not None:
+                self.jobs.discard(job)
     
-PORT = 8000
-
-with socketserver.TCPServer(("", PORT), ArokHandler, bind_and_activate=False) as httpd:
-    httpd.allow_reuse_address = True
-    print("serving at port ", PORT)
-    try:
-        httpd.server_bind()
-        httpd.server_activate()
-        httpd.serve_forever()
-    except:
-        httpd.server_close()
-        print("closed.")
-        raise
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the dictionary builder.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--corenlp-instances", type=int, default=env.CORENLP_INSTANCES,
+                        help="Number of CoreNLP servers kept running for tagging.")
+    parser.add_argument("--tagger", choices=list(TAGGERS), default=env.TAGGER,
+                        help="Tagger used when the upload doesn't pick one.")
+    parser.add_argument("--workers", type=int, default=env.WORKERS,
+                        help="Processes used to build entries from large toolbox files (1 builds them in the server process, usually faster).")
+    parser.add_argument("--build-workers", type=int, default=env.BUILD_WORKERS,
+                        help="Builds (tagging, LaTeX, pdflatex) that run at the same time.")
+    parser.add_argument("--queue-depth", type=int, default=env.BUILD_QUEUE_DEPTH,
+                        help="Builds that can wait for a turn before uploads are turned away as busy.")
+    parser.add_argument("--latex-shards", type=int, default=env.LATEX_SHARDS,
+                        help="Split the dictionary into this many documents by letter and compile them in parallel.")
+    parser.add_argument("--job-ttl", type=float, default=env.JOB_TTL,
+                        help="Seconds a finished job and its PDF are kept around for.")
+    parser.add_argument("--profile", metavar="DIR", default=env.PROFILE_DIR,
+                        help="Run every build under cProfile and dump the stats to DIR/<job id>.prof.")
+    parser.add_argument("--trace-memory", action="store_true", default=env.TRACE_MEMORY,
+                        help="Measure the peak Python memory of every stage with tracemalloc (slows builds down).")
+    args = parser.parse_args()
+    ArokHandler.default_tagger = args.tagger
+    ArokHandler.workers = args.workers
+    ArokHandler.latex_shards = args.latex_shards
+    ArokHandler.profile_dir = args.profile
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+    if args.trace_memory:
+        tracemalloc.start()
+    ArokHandler.build_pool = BuildPool(args.build_workers, args.queue_depth)
+    ArokHandler.jobs = JobStore(env.JOBS_DIR, args.job_ttl)
+
+    # Boot the taggers once, every request shares them.
+    if args.tagger == "corenlp":
+        start_service(args.corenlp_instances)
+    # Each request gets its own thread, so a long build never holds up anyone else's page load.
+    with http.server.ThreadingHTTPServer(("", args.port), ArokHandler, bind_and_activate=False) as httpd:
+        httpd.allow_reuse_address = True
+        print("serving at port ", args.port)
+        try:
+            httpd.server_bind()
+            httpd.server_activate()
+            httpd.serve_forever()
+        except:
+            httpd.server_close()
+            print("closed.")
+            raise
+        finally:
+            ArokHandler.build_pool.shutdown()
+            stop_service()
@@ -0,0 +1,61 @@
+"""
+snapshot.py: Finished dictionaries saved to disk, so building the same upload again (after a restart too) skips parsing and tagging.
+"""
+import gc
+import os
+import pickle
+import struct
+import threading
+from cache import content_hash
+from entries import Dictionary
+from taggers import Tagger
+
+# Bump whenever what gets pickled changes shape, so older snapshots are ignored instead of misread.
+FORMAT_VERSION = 1
+MAGIC = b"AROKDICT"
+# The magic, the format version and the hash of what the dictionary was built from, then the pickled Dictionary.
+_HEADER = struct.Struct(">8sH32s")
+
+def snapshot_file(directory: str, name: str | None) -> str:
+    # One snapshot per upload file name, like the previous builds kept in memory.
+    return os.path.join(directory, f"{content_hash(name or '')}.snapshot")
+
+def save_snapshot(path: str, dictionary: Dictionary, source: str, keep: int):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    with open(partial, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, bytes.fromhex(source)))
+        pickle.dump(dictionary, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(partial, path)
+    # Only the snapshots of the `keep` files built most recently stay around.
+    directory = os.path.dirname(path)
+    snapshots = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".snapshot")]
+    for stale in sorted(snapshots, key=os.path.getmtime, reverse=True)[keep:]:
+        os.remove(stale)
+
+def unpickle(f):
+    # Collections triggered by every object allocated while unpickling take most of the time and find nothing to free.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return pickle.load(f)
+    finally:
+        if enabled:
+            gc.enable()
+
+def load_snapshot(path: str, source: str, tagger: Tagger, data: list[list[tuple[str, str]]]) -> Dictionary | None:
+    # None unless there is a snapshot of this very source, in this format; the caller builds the dictionary then.
+    try:
+        with open(path, "rb") as f:
+            if f.read(_HEADER.size) != _HEADER.pack(MAGIC, FORMAT_VERSION, bytes.fromhex(source)):
+                return None
+            dictionary = unpickle(f)
+            os.utime(f.fileno())
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        print(f"Ignoring unreadable snapshot {path}: {e!r}")
+        return None
+    dictionary.tagger = tagger
+    dictionary.data = data
+    return dictionary
@@ -1,15 +1,25 @@
-from nltk.parse.corenlp import CoreNLPServer, CoreNLPParser
+from nltk.parse.corenlp import CoreNLPServer, CoreNLPParser, CoreNLPServerError
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import atexit
 import os
+import threading
+import requests
+import env
+from cache import TagCache
 
-os.environ["CLASSPATH"]="./stanford-corenlp-4.5.9"
+CORENLP_VERSION = "4.5.9"
+os.environ["CLASSPATH"]=f"./stanford-corenlp-{CORENLP_VERSION}"
 
-def do_call(pos, sentences):
+ANNOTATORS = "tokenize,ssplit,pos,lemma"
+
+def do_call(pos, sentences, timeout=env.TAG_TIMEOUT):
     default_properties = {
         "ssplit.eolonly": "true",
-        "annotators": "tokenize,ssplit,pos,lemma",
+        "annotators": ANNOTATORS,
     }
 
-    tagged_call = pos.api_call('\n'.join(sentences), properties=default_properties)
+    tagged_call = pos.api_call('\n'.join(sentences), properties=default_properties, timeout=timeout)
     results = [
                 [
                     (token["word"], token["pos"], token["lemma"])
@@ -18,12 +28,170 @@ def do_call(pos, sentences):
                 for tagged_sentence in tagged_call["sentences"]
             ]
     return results
+
+class PooledServer:
+    """A single CoreNLP JVM that stays up between requests."""
+
+    def __init__(self):
+        self.server = None
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    def start(self):
+        # Only preload what do_call asks for, the nltk default also loads both parsers.
+        self.server = CoreNLPServer(corenlp_options=["-preload", ANNOTATORS])
+        try:
+            self.server.start()
+        except CoreNLPServerError:
+            self.server.stop()
+            raise
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+    def alive(self) -> bool:
+        if self.server is None or self.server.popen.poll() is not None:
+            return False
+        try:
+            return requests.get(self.server.url + "/live", timeout=env.CORENLP_HEALTH_TIMEOUT).ok
+        except requests.exceptions.RequestException:
+            return False
+
+    def ensure_alive(self):
+        with self.lock:
+            if not self.alive():
+                print(f"CoreNLP server at {self.server.url if self.server else '(not started)'} is down, restarting.")
+                self.stop()
+                self.start()
+
+class TaggerService:
+    """
+    Keeps `instances` CoreNLP servers running and spreads batches over them,
+    so concurrent builds don't queue on one JVM and no build pays for a JVM boot.
+    """
+
+    def __init__(self, instances: int = 1, health_interval: float = 30):
+        self.instances = instances
+        self.health_interval = health_interval
+        self.servers: list[PooledServer] = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.watcher = threading.Thread(target=self.watch, daemon=True)
+
+    def start(self):
+        # Start them one at a time: CoreNLPServer picks its port when constructed.
+        for _ in range(self.instances):
+            server = PooledServer()
+            server.start()
+            self.servers.append(server)
+        self.watcher.start()
+
+    def stop(self):
+        self.stopped.set()
+        for server in self.servers:
+            with server.lock:
+                server.stop()
+
+    def watch(self):
+        while not self.stopped.wait(self.health_interval):
+            for server in self.servers:
+                try:
+                    server.ensure_alive()
+                except CoreNLPServerError as e:
+                    print(f"Could not restart CoreNLP server: {e}")
+
+    @contextmanager
+    def parser(self, tried: set[PooledServer] | None = None):
+        # CoreNLP handles concurrent requests itself, so hand out the least busy server
+        # rather than locking one per caller. Each caller gets its own HTTP session.
+        # A retry passes the servers it already tried, and gets another one while there is one.
+        with self.lock:
+            server = min([x for x in self.servers if x not in (tried or ())] or self.servers, key=lambda x: x.in_flight)
+            server.in_flight += 1
+        if tried is not None:
+            tried.add(server)
+        try:
+            server.ensure_alive()
+            yield CoreNLPParser(server.server.url)
+        finally:
+            with self.lock:
+                server.in_flight -= 1
+
+_service: TaggerService | None = None
+_service_lock = threading.Lock()
+
+def start_service(instances: int = env.CORENLP_INSTANCES) -> TaggerService:
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = TaggerService(instances, env.CORENLP_HEALTH_INTERVAL)
+            _service.start()
+            atexit.register(stop_service)
+        return _service
+
+def stop_service():
+    global _service
+    with _service_lock:
+        if _service is not None:
+            _service.stop()
+            _service = None
+
+_cache: TagCache | None = None
+
+def get_cache() -> TagCache:
+    global _cache
+    with _service_lock:
+        if _cache is None:
+            _cache = TagCache(env.TAG_CACHE_FILE, f"corenlp-{CORENLP_VERSION}:{ANNOTATORS}", env.TAG_CACHE_MAX_BYTES)
+        return _cache
+
+def cache_stats() -> dict[str, int] | None:
+    # Without opening the cache, for servers that never tag with CoreNLP.
+    with _service_lock:
+        return _cache.stats() if _cache is not None else None
+
+def tag_batch(service: TaggerService, batch: list[str]) -> list[list[tuple[str,str,str]]]:
+    tried: set[PooledServer] = set()
+    attempt = 0
+    while True:
+        try:
+            with service.parser(tried) as pos:
+                tagged = do_call(pos, batch)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            if attempt == env.TAG_RETRIES:
+                raise
+            attempt += 1
+            # A server that went down is restarted by ensure_alive the next time it is handed out.
+            what = "timed out" if isinstance(e, requests.exceptions.Timeout) else "lost its connection"
+            print(f"Tagging a batch of {len(batch)} sentences {what}, retrying on another server ({attempt}/{env.TAG_RETRIES}).")
+            continue
+        # Sentences are only told apart by their position, so a batch split any other way can't be matched back to them.
+        if len(tagged) != len(batch):
+            raise CoreNLPServerError(f"CoreNLP returned {len(tagged)} sentences for a batch of {len(batch)}.")
+        return tagged
+
 # The current nltk implementation only accepts pos tags, but we also want lemmas.
 # NOTE: The Stanford NLP parser mentions that repeated calls can get very slow
-#       and recommends separating on multilines.  This is the process we follow here.
-def tag_sentences (sentences : list[str]) -> list[list[tuple[str,str,str]]]:
-    processed_data = []
-    with CoreNLPServer() as server:
-        pos = CoreNLPParser(server.url)
-        processed_data = [ sentence for i in range(0,len(sentences),3000) for sentence in do_call(pos, sentences[i:i+3000])]
-    return processed_data
\ No newline at end of file
+#       and recommends separating on multilines.  This is the process we follow here,
+#       sending the batches concurrently.
+def tag_sentences (sentences : list[str], batch_size: int = env.TAG_BATCH_SIZE, concurrency: int = env.TAG_CONCURRENCY, stats: dict[str, int] | None = None) -> list[list[tuple[str,str,str]]]:
+    cache = get_cache()
+    known = cache.get_many(sentences)
+    # Only what the cache has never seen goes to CoreNLP.
+    missing = list(dict.fromkeys(sentence for sentence in sentences if sentence not in known))
+    if stats is not None:
+        stats["cache_hits"] = stats.get("cache_hits", 0) + len(sentences) - len(missing)
+        stats["sent_to_corenlp"] = stats.get("sent_to_corenlp", 0) + len(missing)
+    if missing:
+        service = start_service()
+        batches = [missing[i:i+batch_size] for i in range(0,len(missing),batch_size)]
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            # map keeps the input order no matter which batch finishes first. Each batch is cached
+            # once tag_batch has checked it, so a batch that fails keeps the ones before it, and nothing of its own.
+            for batch, tagged_batch in zip(batches, pool.map(lambda batch: tag_batch(service, batch), batches)):
+                tagged = dict(zip(batch, tagged_batch))
+                cache.put_many(tagged)
+                known.update(tagged)
+    return [known[sentence] for sentence in sentences]
@@ -0,0 +1,101 @@
+"""
+synthetic.py: Generates toolbox files shaped like ours, for benchmarks.
+
+    python synthetic.py 100000 > synthetic.toolbox
+    python synthetic.py 100000 --senses 6 --subsenses 4 --nesting 0.4 --glp 5 --duplicates 0.2 --seed 1
+"""
+import argparse
+import random
+from typing import Iterator
+
+_SRO_SYLLABLES = ["a", "â", "i", "î", "o", "ô", "ê", "ka", "ki", "kî", "ko", "kw", "ma", "mi", "mo", "na", "ni", "pa", "pi", "pê", "sa", "si", "sk", "ta", "ti", "tâ", "wa", "wi", "yi", "ci", "hk", "st"]
+_SYLLABICS = "ᐊᐋᐃᐄᐅᐆᐁᑲᑭᑮᑯᒪᒥᒧᓇᓂᐸᐱᐯᓴᓯᑕᑎᑖᐘᐏᔨᒋᐦᐢ"
+_POS = ["VAI-1", "VAI-2", "VAI-3", "VTA-1", "VTA-2", "VTA-4", "VTI-1", "VTI-2", "VII-1n", "VII-2v", "NA-1", "NA-2", "NI-1", "NI-3", "NDA-1", "IPC", "IPV"]
+_VERBS = ["runs", "walks", "sees", "cooks", "sings", "carries", "hurries", "fixes", "washes", "makes", "takes", "is cooking", "has", "goes", "ties", "lies down", "works"]
+_OBJECTS = ["s.o.", "s.t.", "water", "a house", "the dog", "fish", "berries", "wood", "a canoe", "the sky", "people", "things"]
+_ADJUNCTS = ["quickly", "around", "away", "hither", "by hand", "in the water", "with a stick", "for s.o.", "to the camp", "at night"]
+_ASIDES = ["e.g. bird", "cf. tâpwê", "lit. \"it is cold\"", "as a hoop; a ring", "archaic", "esp. a moose", "i.e. fall, autumn"]
+_NOUNS = ["water", "house", "dog", "fish", "berry", "canoe", "camp", "sky", "wood", "rope", "moose", "bird", "hoop", "path", "fire"]
+_HEADWORDS = _NOUNS + ["run", "walk", "see", "cook", "sing", "carry", "hurry", "fix", "wash", "make", "take", "go", "tie", "lie", "work"]
+_QUALIFIERS = ["big", "small", "red", "old", "young", "1", "2", "10", "far", "near", "wet", "dry", "Cree", "spring", "winter", "river", "sweet", "bitter", "first", "last"]
+
+def make_heading(rng: random.Random) -> str:
+    heading = rng.choice(_HEADWORDS)
+    return f"{rng.choice(_QUALIFIERS)} {heading}" if rng.random() < 0.5 else heading
+
+def make_word(rng: random.Random) -> str:
+    return ''.join(rng.choice(_SRO_SYLLABLES) for _ in range(rng.randint(2, 6))) + rng.choice(["w", "n", "k", "wak", ""])
+
+def make_subsense(rng: random.Random, nesting: float) -> str:
+    if rng.random() < 0.3:
+        sense = rng.choice(["my ", "a ", "the ", ""]) + rng.choice(_NOUNS)
+    else:
+        sense = f"{rng.choice(['s/he', 'S/he', 'it', 's/he'])} {rng.choice(_VERBS)}"
+        if rng.random() < 0.6:
+            sense += " " + rng.choice(_OBJECTS)
+        if rng.random() < 0.3:
+            sense += " " + rng.choice(_ADJUNCTS)
+    if rng.random() < nesting:
+        # Nested asides, sometimes with their own separators, now and then a stray bracket.
+        aside = rng.choice(_ASIDES)
+        sense += rng.choice([f" ({aside})", f" [{aside}]", f" ({aside}, [sic])", f" ({aside}"])
+    return sense
+
+def make_definition(rng: random.Random, senses: int, subsenses: int, nesting: float) -> str:
+    return "; ".join(
+        ", ".join(make_subsense(rng, nesting) for _ in range(rng.randint(1, subsenses)))
+        for _ in range(rng.randint(1, senses))
+    )
+
+def iter_synthetic_toolbox(entries: int, seed: int = 0, senses: int = 3, nesting: float = 0.15, subsenses: int = 3, glp: int = 2, duplicates: float = 0.0) -> Iterator[str]:
+    """
+    `senses` and `subsenses` bound how long each \\def is, `nesting` is how often a subsense carries a
+    bracketed aside, `glp` bounds the \\glp lines per entry and `duplicates` is how often an entry
+    repeats the definition of an earlier one (homographs, or the same sense under another stem).
+    The same arguments always give the same file.
+    """
+    rng = random.Random(seed)
+    definitions: list[str] = []
+    yield "\\_sh v3.0  400  MDF 4.0"
+    yield ""
+    for _ in range(entries):
+        word = make_word(rng)
+        yield f"\\sro {word}"
+        yield f"\\syl {''.join(rng.choice(_SYLLABICS) for _ in range(len(word) // 2))}"
+        yield f"\\ps {rng.choice(_POS)}"
+        yield f"\\stm {word[:-1]}-"
+        if duplicates and definitions and rng.random() < duplicates:
+            definition = rng.choice(definitions)
+        else:
+            definition = make_definition(rng, senses, subsenses, nesting)
+            if duplicates:
+                definitions.append(definition)
+        yield f"\\def {definition}"
+        yield f"\\gl {make_heading(rng)}"
+        for _ in range(rng.randint(0, glp)):
+            heading = make_heading(rng)
+            yield f"\\glp {heading} - {rng.choice([heading + ' ' + rng.choice(_ADJUNCTS), rng.choice(_QUALIFIERS) + ' ' + heading, rng.choice(_ADJUNCTS)])}"
+        yield f"\\dt {rng.randint(1, 28):02}/Jan/20{rng.randint(10, 25)}"
+        yield ""
+
+def synthetic_toolbox(entries: int, **options) -> str:
+    return '\n'.join(iter_synthetic_toolbox(entries, **options))
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--senses", type=int, default=3, help="Most senses (; separated) in a definition.")
+    parser.add_argument("--subsenses", type=int, default=3, help="Most subsenses (, separated) in a sense.")
+    parser.add_argument("--nesting", type=float, default=0.15, help="Chance of a bracketed aside in a subsense.")
+    parser.add_argument("--glp", type=int, default=2, help="Most \\glp lines in an entry.")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="Chance an entry repeats an earlier definition.")
+
+def options(args: argparse.Namespace) -> dict:
+    return {name: getattr(args, name) for name in ("seed", "senses", "subsenses", "nesting", "glp", "duplicates")}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic toolbox file to stdout.")
+    parser.add_argument("entries", type=int, nargs="?", default=1000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    for line in iter_synthetic_toolbox(args.entries, **options(args)):
+        print(line)
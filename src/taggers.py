@@ -0,0 +1,156 @@
+"""
+taggers.py: The backends that turn senses into (word, pos, lemma) triples for pick_sense.
+"""
+import re
+
+class Tagger:
+    name = ""
+
+    def __init__(self):
+        # Counts a backend wants to report to the build metrics (cache hits and the like).
+        self.stats: dict[str, int] = dict()
+
+    def tag(self, sentences: list[str]) -> list[list[tuple[str,str,str]]]:
+        raise NotImplementedError
+
+class CoreNLPTagger(Tagger):
+    """The reference backend, backed by the shared CoreNLP service in stanford.py."""
+    name = "corenlp"
+
+    def tag(self, sentences: list[str]) -> list[list[tuple[str,str,str]]]:
+        # Imported here so the other backends work without nltk, requests or Java around.
+        from stanford import tag_sentences
+        return tag_sentences(sentences, stats=self.stats)
+
+# Roughly the Penn Treebank tokenization CoreNLP uses: clitics split off, abbreviations and hyphenated words kept whole.
+_TOKEN = re.compile(r"(?:[^\W\d_]\.){2,}|\w+?(?=n't\b)|n't\b|'\w*|\w+(?:-\w+)*|[^\w\s]")
+
+_SUBJECTS = {"she", "he", "it", "they", "i", "you", "we"}
+_IRREGULAR = {
+    "is": "be", "are": "be", "was": "be", "were": "be", "am": "be", "been": "be", "being": "be", "be": "be",
+    "has": "have", "had": "have", "having": "have", "have": "have",
+    "does": "do", "did": "do", "done": "do", "doing": "do", "do": "do",
+    "goes": "go", "went": "go", "gone": "go",
+    "makes": "make", "made": "make", "making": "make",
+    "takes": "take", "took": "take", "taken": "take", "taking": "take",
+    "gives": "give", "gave": "give", "given": "give", "giving": "give",
+    "comes": "come", "came": "come", "coming": "come",
+    "sees": "see", "saw": "see", "seen": "see",
+    "gets": "get", "got": "get", "gotten": "get",
+    "says": "say", "said": "say",
+    "lies": "lie", "lay": "lie", "lying": "lie",
+    "dies": "die", "dying": "die",
+    "ties": "tie", "tying": "tie",
+    "puts": "put", "sits": "sit", "sat": "sit", "sitting": "sit",
+    "knows": "know", "knew": "know", "known": "know",
+    "thinks": "think", "thought": "think",
+    "brings": "bring", "brought": "bring",
+    "leaves": "leave", "left": "leave",
+    "uses": "use", "using": "use", "used": "use",
+    "lives": "live", "living": "live", "lived": "live",
+    "moves": "move", "moving": "move", "moved": "move",
+}
+_AUXILIARIES = {"is", "are", "was", "were", "am", "be", "been", "has", "have", "had", "does", "do", "did", "can", "will", "would", "should", "could", "may", "might", "must"}
+_MODALS = {"can", "will", "would", "should", "could", "may", "might", "must"}
+_COORDINATION = {"and", "or"}
+
+def lemmatize_verb(word: str) -> str:
+    lower = word.lower()
+    if lower in _IRREGULAR:
+        return _IRREGULAR[lower]
+    if lower.endswith("ies") and len(lower) > 4:
+        return lower[:-3] + "y"
+    if lower.endswith(("sses", "shes", "ches", "xes", "zes", "oes")):
+        return lower[:-2]
+    if lower.endswith("s") and not lower.endswith(("ss", "us", "is")):
+        return lower[:-1]
+    for suffix in ("ing", "ed"):
+        if lower.endswith(suffix) and len(lower) > len(suffix) + 2:
+            stem = lower[:-len(suffix)]
+            if suffix == "ed" and stem.endswith("i"):
+                return stem[:-1] + "y"
+            if len(stem) > 2 and stem[-1] == stem[-2] and stem[-1] not in "lsz":
+                return stem[:-1]
+            return stem
+    return lower
+
+def verb_tag(word: str) -> str:
+    lower = word.lower()
+    if lower in _MODALS:
+        return "MD"
+    if lower.endswith("ing"):
+        return "VBG"
+    if lower.endswith("ed") or lower in {"was", "were", "had", "did", "went", "made", "took", "gave", "came", "saw", "got", "said", "knew", "thought", "brought", "left", "sat"}:
+        return "VBD"
+    if lower.endswith("s") and lower != "has" or lower in {"is", "has", "does"}:
+        return "VBZ"
+    return "VB"
+
+class RulesTagger(Tagger):
+    """
+    A small in-process tagger tuned to what pick_sense reads: the lemma of the first and last
+    tokens, and which tokens are verbs (whose lemma replaces the word). Verbs are found from
+    the shape of our definitions: whatever follows a subject pronoun, an auxiliary or "to",
+    plus verbs coordinated with those.
+    """
+    name = "rules"
+
+    def tag_sentence(self, sentence: str) -> list[tuple[str,str,str]]:
+        tokens = _TOKEN.findall(sentence)
+        tagged = []
+        expect_verb = False
+        last_verb = False
+        for i, word in enumerate(tokens):
+            lower = word.lower()
+            is_verb = False
+            if lower in _AUXILIARIES and i > 0 and tokens[i-1].lower() in _SUBJECTS:
+                is_verb = True
+            elif expect_verb and word[:1].isalpha() and lower not in _SUBJECTS and lower not in _COORDINATION:
+                is_verb = not lower.endswith("ly") or lower in _IRREGULAR
+            if is_verb:
+                tag = verb_tag(word)
+                tagged.append((word, tag, lemmatize_verb(word) if tag != "MD" else lower))
+                # Auxiliaries and modals take a verb right after them ("s/he is cooking", "s/he can sing").
+                expect_verb = lower in _AUXILIARIES
+                last_verb = True
+                continue
+            if expect_verb and lower.endswith("ly"):
+                # Adverbs between subject and verb: "s/he quickly runs".
+                tagged.append((word, "RB", lower))
+                continue
+            if lower in _SUBJECTS or lower == "to":
+                tag = "PRP" if lower in _SUBJECTS else "TO"
+                expect_verb = True
+            elif lower in _COORDINATION and last_verb:
+                tag = "CC"
+                expect_verb = True
+            else:
+                tag = "NN" if word[:1].isalnum() else word
+                expect_verb = False
+            last_verb = False
+            tagged.append((word, tag, lower if word[:1].isalpha() else word))
+        return tagged
+
+    def tag(self, sentences: list[str]) -> list[list[tuple[str,str,str]]]:
+        return [self.tag_sentence(sentence) for sentence in sentences]
+
+class StubTagger(Tagger):
+    """
+    Tags every token as a noun that is its own lemma. Costs next to nothing, so benchmarks measure
+    everything but tagging. Not in TAGGERS: its dictionaries are wrong, so builds can't pick it.
+    """
+    name = "stub"
+
+    def tag(self, sentences: list[str]) -> list[list[tuple[str,str,str]]]:
+        return [[(word, "NN", word.lower()) for word in sentence.split()] or [("", "NN", "")] for sentence in sentences]
+
+# The taggers builds can pick by name.
+TAGGERS: dict[str, type[Tagger]] = {
+    CoreNLPTagger.name: CoreNLPTagger,
+    RulesTagger.name: RulesTagger,
+}
+
+def get_tagger(name: str) -> Tagger:
+    if name not in TAGGERS:
+        raise ValueError(f"Unknown tagger {name}. Pick one of: {', '.join(TAGGERS)}.")
+    return TAGGERS[name]()
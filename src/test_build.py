@@ -0,0 +1,165 @@
+"""
+test_build.py: Building the dictionary, and the tools that make its toolbox file. Run from src/ with `python -m unittest`.
+"""
+import contextlib
+import io
+import json
+import os
+import re
+import tempfile
+import unittest
+from operator import itemgetter
+from unittest import mock
+import natsort
+import build
+from entries import NATSORT_ALG, make_dictionary, natural_key, plain_defn, sort_subheading_keys
+from merge import CsvIndex, merge_toolbox
+from parse import load_toolbox
+from resolve import DateOnlyEnding, KeepFields, Resolver
+from synthetic import synthetic_toolbox
+from taggers import get_tagger
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+
+def fake_pdflatex(tex_file: str) -> bytes:
+    # Like PdfLatexBuilder, reads the LaTeX from its own temporary directory: what it includes has to be found from there.
+    with open(tex_file) as f:
+        latex = f.read()
+    with tempfile.TemporaryDirectory() as elsewhere:
+        for included in re.findall(r"\\includepdf\[[^]]*\]\{([^}]*)\}", latex):
+            if not os.path.exists(os.path.join(elsewhere, included)):
+                raise FileNotFoundError(included)
+    return b"%PDF-1.5\n"
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self):
+        # The templates are looked up relative to the working directory, and the scratch directory relative to it too.
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(SRC)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.dictionary = make_dictionary(load_toolbox(synthetic_toolbox(200)), get_tagger("rules"), workers=1)
+
+    def test_relative_scratch_dir(self):
+        with tempfile.TemporaryDirectory(dir=SRC) as root, tempfile.TemporaryDirectory(prefix="arok-", dir=os.path.relpath(root)) as scratch:
+            self.assertFalse(os.path.isabs(scratch))
+            tex_files = build.write_latex(self.dictionary, scratch, shards=3)
+            self.assertEqual(len(tex_files), 3)
+            with mock.patch.object(build, "compile_latex", side_effect=fake_pdflatex) as compile_latex:
+                build.compile_shards(tex_files, scratch)
+            stitched = compile_latex.call_args_list[-1].args[0]
+            self.assertEqual(stitched, os.path.join(scratch, "dict.tex"))
+            self.assertEqual(compile_latex.call_count, 4)
+
+class PreviewTest(unittest.TestCase):
+
+    def test_json_definitions_are_not_latex(self):
+        toolbox = "\\_sh v3.0  400  MDF 4.0\n\n\\sro atim\n\\syl ᐊᑎᒼ\n\\ps NA-1\n\\stm atim-\n\\def a dog & {cat} for $5 #1\n\\gl dog\n\\dt 01/Jan/2020\n"
+        with contextlib.redirect_stdout(io.StringIO()):
+            dictionary = make_dictionary(load_toolbox(toolbox), get_tagger("rules"), workers=1)
+        f = io.StringIO()
+        dictionary.write_json(f)
+        [heading] = json.loads(f.getvalue())
+        self.assertEqual(heading["heading"], "dog")
+        [entry] = heading["entries"]
+        self.assertEqual(entry["definitions"], ["a dog & {cat} for $5 #1"])
+        self.assertNotIn("\\", entry["definition"])
+        self.assertTrue(entry["definition"].startswith("a~ "))
+        for char in "&{}$#":
+            self.assertIn(char, entry["definition"])
+
+    def test_plain_defn_is_not_unescaped_latex(self):
+        # Backslashes of the toolbox file itself stay as they are, unescaping the LaTeX would have eaten them.
+        self.assertEqual(plain_defn(("x\\&y ", "dog", " \\{z\\}")), "x\\&y~ \\{z\\}")
+        self.assertEqual(plain_defn(("", "dog", "")), "")
+        self.assertEqual(plain_defn((" a dog ", "", "")), "a dog")
+
+class SortTest(unittest.TestCase):
+    # Numbers, accents, case, hyphens, punctuation and nothing at all.
+    edge_cases = ["", " ", "2", "10", "a2", "a10", "A10", "a-2", "a 2", "a1b", "a01", "1a", "-1", "1.5", "1,5",
+                  "é", "e", "E", "ê", "éa", "eb", "Dog", "dog", "dog-", "-dog", "dog's", "(dog)", "dog 2", "dog10", "DOG"]
+
+    def headings(self) -> list[str]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            dictionary = make_dictionary(load_toolbox(synthetic_toolbox(300)), get_tagger("rules"), workers=1)
+        return list(dictionary.entries) + self.edge_cases
+
+    def test_one_sort_is_the_two_pass_natsort(self):
+        # What the sort functions did before natural_key: natsort on the second part, then again on the first.
+        headings = self.headings()
+        self.assertEqual(sorted(headings, key=natural_key), natsort.natsorted(headings, alg=NATSORT_ALG))
+        for heading in ["dog", "a", "1", "-"]:
+            keys = [before + heading + after for before in self.edge_cases[:12] for after in self.edge_cases[-12:]]
+            candidates = natsort.natsorted([key.partition(heading) for key in keys], key=itemgetter(2), alg=NATSORT_ALG)
+            reference = [''.join(t) for t in natsort.natsorted(candidates, key=itemgetter(0), alg=NATSORT_ALG)]
+            with self.subTest(heading=heading):
+                self.assertEqual(sort_subheading_keys(keys, heading), reference)
+
+class MergeTest(unittest.TestCase):
+    toolbox = "\n".join([
+        "\\_sh v3.0  400  MDF 4.0", "",
+        "\\sro atim", "\\ps NA-1", "\\def dog", "\\src CW", "\\dt 01/Jan/2020", "",
+        "\\sro atim", "\\ps NA-1", "\\def horse", "\\src old", "\\dt 01/Jan/2020", "",
+        "\\sro minos", "\\ps NA-1", "\\def cat", "\\dt 01/Jan/2020", "",
+    ])
+    csv = "\\sro,\\ps,\\def,\\src\natim,NA-1,dog,CW;; MD\natim,NA-1,dog,CW;; MD\natim,NA-1,horses,AE\nmaskwa,NA-1,bear,CW\n,,,empty key\n"
+
+    def test_merge(self):
+        index = CsvIndex.from_csv(io.StringIO(self.csv), ["\\src"])
+        self.assertEqual(index.ambiguous, [])
+        output = io.StringIO()
+        report = merge_toolbox(self.toolbox, index, output)
+        self.assertEqual(output.getvalue().split("\n\n")[1:4], [
+            "\\sro atim\n\\ps NA-1\n\\def dog\n\\src CW\n\\src MD\n\\dt 01/Jan/2020",
+            # No row for this one: its \src is emptied, and it is a near miss since there are rows for atim.
+            "\\sro atim\n\\ps NA-1\n\\def horse\n\\src\n\\dt 01/Jan/2020",
+            "\\sro minos\n\\ps NA-1\n\\def cat\n\\src\n\\dt 01/Jan/2020",
+        ])
+        self.assertEqual((report.entries, report.merged, report.missing), (3, 1, 2))
+        self.assertEqual(report.near_misses, [("atim", "NA-1", "horse")])
+        self.assertEqual(report.unmatched, [("atim", "NA-1", "horses"), ("maskwa", "NA-1", "bear")])
+        report = merge_toolbox(self.toolbox, index, io.StringIO(), expected_unmatched=[("maskwa", "NA-1", "bear")])
+        self.assertEqual(report.unmatched, [("atim", "NA-1", "horses")])
+
+    def test_ambiguous_rows(self):
+        rows = self.csv + "atim,NA-1,dog,AE\n"
+        self.assertEqual(CsvIndex.from_csv(io.StringIO(rows), ["\\src"]).ambiguous, [("atim", "NA-1", "dog")])
+        index = CsvIndex.from_csv(io.StringIO(rows), ["\\src"], duplicates=[("atim", "NA-1", "dog")])
+        self.assertEqual(index.ambiguous, [])
+        # The first row still wins.
+        self.assertEqual(index.rows[("atim", "NA-1", "dog")], ("CW;; MD",))
+
+class ResolveTest(unittest.TestCase):
+
+    def resolve(self, text: str) -> tuple[str, Resolver]:
+        resolver = Resolver([DateOnlyEnding({"\\src"}), KeepFields({"\\gl"}, "right")])
+        output = io.StringIO()
+        resolver.resolve(io.StringIO(text), output)
+        return output.getvalue(), resolver
+
+    def test_resolve(self):
+        text = (
+            "\\sro atim\r\n\\def dog\r\n"
+            # Only a source and a date on the left: those and the rest of the right.
+            "<<<<<<< ours\r\n\\src CW\r\n\\dt 02/Jan/2020\r\n=======\r\n\\vgl dog\r\n\\dt 01/Jan/2020\r\n>>>>>>> theirs\r\n"
+            "\r\n\\sro minos\r\n"
+            # The same but for \gl, with the common ancestor of a diff3 conflict.
+            "<<<<<<< ours\r\n\\def cat\r\n\\gl cat\r\n||||||| base\r\n\\def cat\r\n=======\r\n\\def cat\r\n\\gl feline\r\n>>>>>>> theirs\r\n"
+        )
+        output, resolver = self.resolve(text)
+        self.assertEqual(output, "\\sro atim\r\n\\def dog\r\n\\src CW\r\n\\vgl dog\r\n\\dt 01/Jan/2020\r\n\r\n\\sro minos\r\n\\def cat\r\n\\gl feline\r\n")
+        self.assertEqual(resolver.stats, {"date-only ending": 1, "keep right \\gl": 1, "unresolved": 0})
+
+    def test_unresolved(self):
+        # Left as it was, markers, ancestor and line endings included.
+        text = "\\sro atim\n<<<<<<< ours\n\\def dog\n||||||| base\n\\def dgo\n=======\r\n\\def hound\n>>>>>>> theirs\n\\dt 01/Jan/2020\n"
+        output, resolver = self.resolve(text)
+        self.assertEqual(output, text)
+        self.assertEqual((resolver.conflicts, resolver.stats["unresolved"]), (1, 1))
+
+    def test_conflict_never_ends(self):
+        with self.assertRaisesRegex(ValueError, "line 2 never ends"):
+            self.resolve("\\sro atim\n<<<<<<< ours\n\\def dog\n=======\n\\def hound\n")
+
+if __name__ == "__main__":
+    unittest.main()
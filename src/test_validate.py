@@ -0,0 +1,64 @@
+"""
+test_validate.py: What /validate accepts has to build. Run from src/ with `python -m unittest`.
+"""
+import contextlib
+import io
+import os
+import unittest
+from entries import make_dictionary, validate_toolbox
+from parse import load_toolbox
+from synthetic import iter_synthetic_toolbox
+from taggers import get_tagger
+
+def setUpModule():
+    # The templates are looked up relative to the working directory.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+def build(toolbox: str):
+    with contextlib.redirect_stdout(io.StringIO()):
+        make_dictionary(load_toolbox(toolbox), get_tagger("rules"), workers=1).latex()
+
+def variants(lines: list[str]):
+    # The file with each line of its first entry dropped in turn, emptied, or made a continuation of the line before.
+    first = lines.index("", 2)
+    for i in range(2, first):
+        yield lines[:i] + lines[i + 1:]
+        yield lines[:i] + [lines[i].partition(" ")[0] + " "] + lines[i + 1:]
+        yield lines[:i] + [lines[i].partition(" ")[2]] + lines[i + 1:]
+
+class ValidateTest(unittest.TestCase):
+    lines = list(iter_synthetic_toolbox(20, seed=3))
+
+    def test_valid_file(self):
+        toolbox = "\n".join(self.lines)
+        self.assertEqual(validate_toolbox(toolbox), (20, []))
+        build(toolbox)
+
+    def test_missing_stem(self):
+        toolbox = "\n".join(line for line in self.lines if not line.startswith("\\stm"))
+        count, errors = validate_toolbox(toolbox)
+        self.assertEqual(count, 20)
+        self.assertEqual(len(errors), 20)
+        self.assertIn("\\stm", errors[0]["error"])
+
+    def test_empty_subheading(self):
+        for glp in ("\\glp dog -", "\\glp - dog"):
+            lines = list(self.lines)
+            lines.insert(lines.index("", 2) - 1, glp)
+            toolbox = "\n".join(lines)
+            with self.subTest(glp=glp):
+                _, errors = validate_toolbox(toolbox)
+                self.assertEqual([error["line"] for error in errors], [lines.index(glp) + 1])
+                # Still built, should anything get past validation.
+                build(toolbox)
+
+    def test_valid_builds(self):
+        for lines in variants(self.lines):
+            toolbox = "\n".join(lines)
+            with self.subTest(toolbox=toolbox[:200]):
+                _, errors = validate_toolbox(toolbox)
+                if not errors:
+                    build(toolbox)
+
+if __name__ == "__main__":
+    unittest.main()